@@ -5,12 +5,31 @@ import psycopg2
 import psycopg2.extras
 import pytz
 import requests
+from urllib.parse import quote
 import json
+import hashlib
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from airflow.hooks.base import BaseHook
 from airflow.models.baseoperator import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from dwh_pool import get_pool, copy_rows
+
+
+def get_dwh_pool(connection):
+    """Общий пул соединений с хранилищем для подключения Airflow."""
+
+    return get_pool(
+        host=connection.host,
+        port=connection.port,
+        database=connection.schema,
+        user=connection.login,
+        password=connection.password,
+    )
+
 
 class MSSQLOperator(BaseOperator):
 
@@ -32,6 +51,8 @@ class MSSQLOperator(BaseOperator):
             ts_field_name - название поля с датой изменения (ts)
             min_source_ts - минимальное значение ts для батча
             max_source_ts - максимальное значение ts для батча
+            partition_filter - условие отбора части данных при
+                parallelism > 1 и partition_by='key' (иначе 1 = 1)
 
     dwh_connection_id: str
         Идентификатор подключения Airflow для хранилища Greenplum
@@ -45,6 +66,9 @@ class MSSQLOperator(BaseOperator):
             min_source_ts - минимальное значение ts для батча
             max_source_ts - максимальное значение ts для батча
             ids - перечень идентификаторов записей в батче
+            ids_table - временная таблица (поле id) с идентификаторами
+                записей батча, если ids_temp_table=True. Пример:
+                DELETE FROM {dwh_table_name} t USING {ids_table} i WHERE t.id = i.id;
 
     source_table_name: str
         название таблицы в источнике
@@ -52,6 +76,36 @@ class MSSQLOperator(BaseOperator):
         название таблицы в dwh
     ts_field_name: str
         название поля с датой изменения (ts)
+    ids_temp_table: bool
+        Если True, идентификаторы батча загружаются через COPY во временную
+        таблицу ids_table вместо формирования списка ids в тексте запроса.
+    ids_type: str
+        Тип поля id временной таблицы ids_table.
+    chunk_interval: datetime.timedelta
+        Если указан, окно [min_source_ts, max_source_ts) извлекается
+        и загружается частями такой длительности. Каждая часть
+        фиксируется в dwh отдельной транзакцией, поэтому прерванный
+        запуск продолжается с последней загруженной части.
+        Части полуоткрытые: скрипты источника и dwh должны отбирать
+        строки условием
+            {ts_field_name} >= '{min_source_ts}' AND {ts_field_name} < '{max_source_ts}',
+        иначе строка на границе частей не попадет ни в одну из них.
+        Проверка check() считает строки по тому же условию.
+    chunk_rows: int
+        Бюджет строк на одну часть. Если часть превышает бюджет,
+        ее интервал делится пополам. Если chunk_interval не указан,
+        начальный интервал - 1 день.
+    parallelism: int
+        Число параллельных запросов к источнику (потоков и соединений).
+    partition_by: str
+        Способ разбиения запроса при parallelism > 1:
+        'ts' - по полуоткрытым диапазонам [min_source_ts, max_source_ts)
+        внутри окна; скрипты должны отбирать строки тем же условием,
+        что и при загрузке частями (см. chunk_interval),
+        'key' - по остатку от деления хэша key_field_name
+        (скрипт должен содержать условие {partition_filter}).
+    key_field_name: str
+        Название ключевого поля в источнике для partition_by='key'.
     """
 
     @apply_defaults
@@ -64,10 +118,24 @@ class MSSQLOperator(BaseOperator):
         source_table_name=None,
         dwh_table_name=None,
         ts_field_name = None,
+        ids_temp_table=False,
+        ids_type='TEXT',
+        chunk_interval=None,
+        chunk_rows=None,
+        parallelism=1,
+        partition_by='ts',
+        key_field_name=None,
         *args,
         **kwargs
     ):
         super().__init__(*args, **kwargs)
+        self.ids_temp_table = ids_temp_table
+        self.ids_type = ids_type
+        self.chunk_interval = chunk_interval
+        self.chunk_rows = chunk_rows
+        self.parallelism = parallelism
+        self.partition_by = partition_by
+        self.key_field_name = key_field_name
         self.data_for_templating = {}
         self.source_con = BaseHook.get_connection(source_connection_id)
         self.source_script_path = source_script_path
@@ -76,6 +144,7 @@ class MSSQLOperator(BaseOperator):
         self.data_for_templating['source_table_name'] = source_table_name
         self.data_for_templating['dwh_table_name'] = dwh_table_name
         self.data_for_templating['ts_field_name'] = ts_field_name
+        self.data_for_templating['partition_filter'] = '1 = 1'
 
     def execute(self, context):
         """
@@ -84,40 +153,111 @@ class MSSQLOperator(BaseOperator):
 
         self.context = context
 
-        dwh_connection = psycopg2.connect(
-            host=self.dwh_con.host,
-            port=self.dwh_con.port,
-            database=self.dwh_con.schema,
-            user=self.dwh_con.login,
-            password=self.dwh_con.password,
-        )
-
-        self.dwh_cur = dwh_connection.cursor()
+        source_connection = pyodbc.connect(self.source_connection_string())
 
-        if os.name == 'nt':
-            driver = 'SQL Server'
-        else:
-            driver = 'ODBC Driver 18 for SQL Server'  
+        self.source_cur = source_connection.cursor()
+        # Пул соединений с источником для параллельного извлечения
+        self.source_pool = None
+
+        try:
+            with get_dwh_pool(self.dwh_con).connection() as dwh_connection:
+                self.dwh_cur = dwh_connection.cursor()
+
+                with dwh_connection, source_connection:
+                    with self.dwh_cur, self.source_cur:
+                        if self.chunk_interval or self.chunk_rows:
+                            self.execute_chunks(dwh_connection)
+                            return
+
+                        self.extract()
+                        if self.data:
+                            self.transform()
+                            self.load()
+                            self.check()
+                        else:
+                            print('Нет данных для загрузки.')
+        finally:
+            if self.source_pool is not None:
+                while not self.source_pool.empty():
+                    self.source_pool.get().close()
+                self.source_pool = None
+
+    def execute_chunks(self, dwh_connection):
+        """
+        Извлечение и загрузка окна [min_source_ts, max_source_ts) частями.
+        После каждой части транзакция dwh фиксируется, тем самым сдвигается
+        максимальный ts в хранилище, от которого считается следующий запуск.
+        """
+        if not self.data_for_templating['ts_field_name']:
+            raise Exception('Для загрузки частями необходимо указать ts_field_name.')
+
+        print('Извлечение данных из MSSQL СУБД частями.')
+
+        self.define_window()
+
+        window_start = self.data_for_templating['min_source_ts']
+        window_end = self.data_for_templating['max_source_ts']
+        # Границы частей считаются в UTC, в шаблон подставляются в том же
+        # виде (с часовым поясом или без), что и границы всего окна
+        if window_start.tzinfo is None:
+            window_start = window_start.replace(tzinfo=pytz.UTC)
+        if window_end.tzinfo is None:
+            window_end = window_end.replace(tzinfo=pytz.UTC)
+        start_naive = self.data_for_templating['min_source_ts'].tzinfo is None
+        end_naive = self.data_for_templating['max_source_ts'].tzinfo is None
+
+        base_interval = self.chunk_interval or dt.timedelta(days=1)
+        interval = base_interval
+        chunk_start = window_start
+
+        while chunk_start < window_end:
+            chunk_end = min(chunk_start + interval, window_end)
+
+            self.data_for_templating['min_source_ts'] = \
+                chunk_start.replace(tzinfo=None) if start_naive else chunk_start
+            self.data_for_templating['max_source_ts'] = \
+                chunk_end.replace(tzinfo=None) if end_naive else chunk_end
+
+            print('Часть:', chunk_start, '-', chunk_end)
+
+            self.data = self.fetch(self.chunk_rows)
+
+            if self.data is None:
+                interval = (chunk_end - chunk_start) / 2
+                if interval < dt.timedelta(seconds=1):
+                    raise Exception(
+                        'Число строк за секунду превышает бюджет части:',
+                        self.chunk_rows,
+                    )
+                print('Превышен бюджет строк, уменьшаю интервал части до', interval)
+                continue
+
+            if self.data:
+                self.transform()
+                self.load()
+                self.check()
+            else:
+                print('Нет данных для загрузки.')
 
-        source_connection = pyodbc.connect(
-            'DRIVER={'+driver+'};SERVER='+self.source_con.host \
-            + ';DATABASE='+self.source_con.schema \
-            + ';ENCRYPT=no;UID='+self.source_con.login \
-            + ';PWD=' + self.source_con.password
-        )        
+            dwh_connection.commit()
+            print('Часть зафиксирована в хранилище.')
 
-        self.source_cur = source_connection.cursor()
+            chunk_start = chunk_end
 
-        with dwh_connection, source_connection:
-            with self.dwh_cur, self.source_cur:
-                self.extract()
-                if self.data:
-                    self.transform()
-                    self.load()
-                    self.check()
-                else:
-                    print('Нет данных для загрузки.')
+            # После уменьшения интервал возвращается к исходному,
+            # если части заметно меньше бюджета
+            if (self.chunk_rows and interval < base_interval
+                    and len(self.data) < self.chunk_rows / 2):
+                interval = min(interval * 2, base_interval)
 
+    def half_open_window(self):
+        """
+        True, если окно делится на части (загрузка частями или параллельное
+        разбиение по ts) и границы окон полуоткрытые: [min_source_ts, max_source_ts).
+        Иначе окно открытое с обеих сторон.
+        """
+        return (bool(self.chunk_interval or self.chunk_rows)
+                or (self.parallelism > 1 and self.partition_by == 'ts'))
 
     def extract(self):
         """
@@ -126,25 +266,39 @@ class MSSQLOperator(BaseOperator):
         print('Извлечение данных из MSSQL СУБД.')
 
         if self.data_for_templating['ts_field_name']:
-            self.dwh_cur.execute(
-                f"""
-                SELECT MAX({self.data_for_templating['ts_field_name']}::TIMESTAMP)
-                FROM {self.data_for_templating['dwh_table_name']};
-                """
-            )
-            self.max_dwh_ts = self.dwh_cur.fetchone()[0]
+            self.define_window()
+
+        self.data = self.fetch()
+
+    def define_window(self):
+        """
+        Определяет окно извлечения [min_source_ts, max_source_ts)
+        по максимальному ts данных в хранилище.
+        """
+        self.dwh_cur.execute(
+            f"""
+            SELECT MAX({self.data_for_templating['ts_field_name']}::TIMESTAMP)
+            FROM {self.data_for_templating['dwh_table_name']};
+            """
+        )
+        self.max_dwh_ts = self.dwh_cur.fetchone()[0]
         
-            print('Максимальный TS данных в хранилище:', self.max_dwh_ts)
+        print('Максимальный TS данных в хранилище:', self.max_dwh_ts)
 
-            self.data_for_templating['max_source_ts'] = (self.context['execution_date'].replace(day=28)
-                                                         + dt.timedelta(days=4)).replace(day=1)
+        self.data_for_templating['max_source_ts'] = (self.context['execution_date'].replace(day=28)
+                                                     + dt.timedelta(days=4)).replace(day=1)
 
-            if (not self.max_dwh_ts 
-                or self.max_dwh_ts.replace(tzinfo=pytz.UTC) > self.data_for_templating['max_source_ts']):
-                self.data_for_templating['min_source_ts'] = self.context['execution_date'] - dt.timedelta(days=1)
-            else:
-                self.data_for_templating['min_source_ts'] = self.max_dwh_ts
+        if (not self.max_dwh_ts 
+            or self.max_dwh_ts.replace(tzinfo=pytz.UTC) > self.data_for_templating['max_source_ts']):
+            self.data_for_templating['min_source_ts'] = self.context['execution_date'] - dt.timedelta(days=1)
+        else:
+            self.data_for_templating['min_source_ts'] = self.max_dwh_ts
 
+    def fetch(self, rows_limit=None):
+        """
+        Выполняет шаблонизированный скрипт в источнике и возвращает строки.
+        Если задан rows_limit и строк больше, возвращает None.
+        """
         print('Открываю sql-скрипт:', self.source_script_path)
 
         with open(
@@ -152,12 +306,131 @@ class MSSQLOperator(BaseOperator):
             'r',
             encoding="utf-8",
         ) as f:
-            query = f.read().format(**self.data_for_templating)
+            script = f.read()
+
+        if self.parallelism > 1:
+            return self.fetch_parallel(script, rows_limit)
+
+        query = script.format(**self.data_for_templating)
         print(query[:100])
 
         print('Выполняю запрос к источнику')
         self.source_cur.execute(query)
-        self.data = self.source_cur.fetchall()
+        return self.fetch_rows(self.source_cur, rows_limit)
+
+    @staticmethod
+    def fetch_rows(cursor, rows_limit=None):
+        """
+        Чтение результата запроса. Если задан rows_limit и строк больше,
+        возвращает None.
+        """
+        if rows_limit is None:
+            return cursor.fetchall()
+
+        rows = cursor.fetchmany(rows_limit + 1)
+        if len(rows) > rows_limit:
+            return None
+        return rows
+
+    def fetch_parallel(self, script, rows_limit=None):
+        """
+        Параллельное извлечение: скрипт разбивается на parallelism частей
+        по полуоткрытым диапазонам ts_field_name (partition_by='ts') или по остатку
+        от деления хэша ключа key_field_name (partition_by='key', условие
+        подставляется в скрипт как partition_filter). Части выполняются
+        в потоках (pyodbc освобождает GIL на время запроса), каждый поток
+        берет соединение из пула соединений с источником.
+        Результаты объединяются в порядке частей.
+        """
+        partitions = []
+
+        if self.partition_by == 'ts':
+            if not self.data_for_templating['ts_field_name']:
+                raise Exception('Для разбиения по ts необходимо указать ts_field_name.')
+            min_source_ts = self.data_for_templating['min_source_ts']
+            max_source_ts = self.data_for_templating['max_source_ts']
+            # Окно делится в UTC, границы подставляются в исходном виде
+            window_start = min_source_ts if min_source_ts.tzinfo else min_source_ts.replace(tzinfo=pytz.UTC)
+            window_end = max_source_ts if max_source_ts.tzinfo else max_source_ts.replace(tzinfo=pytz.UTC)
+            step = (window_end - window_start) / self.parallelism
+            for number in range(self.parallelism):
+                partition_start = window_start + step * number
+                partition_end = window_end if number == self.parallelism - 1 else partition_start + step
+                partitions.append({
+                    **self.data_for_templating,
+                    'min_source_ts': partition_start if min_source_ts.tzinfo else partition_start.replace(tzinfo=None),
+                    'max_source_ts': partition_end if max_source_ts.tzinfo else partition_end.replace(tzinfo=None),
+                })
+        elif self.partition_by == 'key':
+            if not self.key_field_name:
+                raise Exception('Для разбиения по ключу необходимо указать key_field_name.')
+            # Без условия каждая часть выполнит весь запрос и данные задвоятся
+            if '{partition_filter}' not in script:
+                raise Exception('Для разбиения по ключу в скрипте должно быть условие {partition_filter}.')
+            for number in range(self.parallelism):
+                partitions.append({
+                    **self.data_for_templating,
+                    # Остаток берется до ABS: ABS(CHECKSUM(...)) переполняется на -2147483648
+                    'partition_filter':
+                        f'ABS(CHECKSUM({self.key_field_name}) % {self.parallelism}) = {number}',
+                })
+        else:
+            raise Exception(f'Способ разбиения {self.partition_by} не предусмотрен.')
+
+        if self.source_pool is None:
+            self.source_pool = queue.Queue()
+            for _ in range(self.parallelism):
+                self.source_pool.put(pyodbc.connect(self.source_connection_string()))
+
+        def fetch_partition(templating):
+            started = time.perf_counter()
+            connection = self.source_pool.get()
+            try:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(script.format(**templating))
+                    rows = self.fetch_rows(cursor, rows_limit)
+                finally:
+                    cursor.close()
+            finally:
+                self.source_pool.put(connection)
+            return rows, time.perf_counter() - started
+
+        print('Выполняю запрос к источнику в', self.parallelism, 'потоков')
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            results = list(executor.map(fetch_partition, partitions))
+
+        print('Время извлечения частей:')
+        data = []
+        exceeded = False
+        for number, (rows, elapsed) in enumerate(results):
+            print(
+                'Часть', number,
+                'строк:', None if rows is None else len(rows),
+                'время, с:', round(elapsed, 2),
+            )
+            if rows is None:
+                exceeded = True
+            else:
+                data.extend(rows)
+
+        if exceeded or (rows_limit is not None and len(data) > rows_limit):
+            return None
+        return data
+
+    def source_connection_string(self):
+        """Строка подключения pyodbc к источнику."""
+        if os.name == 'nt':
+            driver = 'SQL Server'
+        else:
+            driver = 'ODBC Driver 18 for SQL Server'  
+
+        return (
+            'DRIVER={'+driver+'};SERVER='+self.source_con.host \
+            + ';DATABASE='+self.source_con.schema \
+            + ';ENCRYPT=no;UID='+self.source_con.login \
+            + ';PWD=' + self.source_con.password
+        )
 
     def transform(self):
         """
@@ -177,7 +450,10 @@ class MSSQLOperator(BaseOperator):
             self.dwh_script_path
         )
 
-        self.data_for_templating['ids'] = ','.join(["'"+str(row[0])+"'" for row in self.data])
+        if self.ids_temp_table:
+            self.data_for_templating['ids_table'] = self.stage_ids()
+        else:
+            self.data_for_templating['ids'] = ','.join(["'"+str(row[0])+"'" for row in self.data])
 
         with open(
             self.dwh_script_path,
@@ -195,6 +471,29 @@ class MSSQLOperator(BaseOperator):
         insert_stmt = f"INSERT INTO {self.data_for_templating['dwh_table_name']} VALUES %s"
         psycopg2.extras.execute_values(self.dwh_cur, insert_stmt, self.data)
 
+    def stage_ids(self):
+        """
+        Загрузка идентификаторов батча во временную таблицу через COPY.
+        Удаление в скрипте dwh становится соединением с этой таблицей,
+        и размер текста запроса не зависит от размера батча.
+        """
+        # Имя со схемой pg_temp: DROP не затронет постоянную таблицу
+        # с тем же именем, если временной таблицы еще нет
+        ids_table = 'pg_temp.mssql_operator_batch_ids'
+
+        print('Загружаю идентификаторы батча во временную таблицу', ids_table)
+
+        self.dwh_cur.execute(
+            f"""
+            DROP TABLE IF EXISTS {ids_table};
+            CREATE TEMP TABLE {ids_table} (id {self.ids_type}) ON COMMIT DROP;
+            """
+        )
+        copy_rows(self.dwh_cur, ids_table, ((row[0],) for row in self.data))
+        self.dwh_cur.execute(f'ANALYZE {ids_table};')
+
+        return ids_table
+
     def check(self):
         """
         Проверка результата записи.
@@ -208,7 +507,7 @@ class MSSQLOperator(BaseOperator):
                 f"""
                 SELECT COUNT(*)
                 FROM {self.data_for_templating['dwh_table_name']}
-                WHERE {self.data_for_templating['ts_field_name']} > '{self.data_for_templating['min_source_ts']}'
+                WHERE {self.data_for_templating['ts_field_name']} {'>=' if self.half_open_window() else '>'} '{self.data_for_templating['min_source_ts']}'
                     AND {self.data_for_templating['ts_field_name']} < '{self.data_for_templating['max_source_ts']}';
                 """
             )
@@ -236,6 +535,43 @@ class MSSQLOperator(BaseOperator):
 
 class MDAuditOperator(BaseOperator):
 
+    """
+    Данный класс извлекает проверки из REST API MDAudit и записывает их
+    в СУБД Greenplum.
+
+    Атрибуты:
+    ----------
+    dwh_connection_id: str
+        Идентификатор подключения Airflow для хранилища Greenplum
+    table_name: str
+        название таблицы в dwh (id, last_modified_at, данные в json)
+    source_connection_id: str
+        Идентификатор подключения Airflow для REST API
+    endpoint: str
+        Адрес метода API, шаблонизируется переменными start_date и end_date
+    sync_mode: str
+        'full' - каждый запуск запрашивает записи, измененные за последние
+        reconcile_days дней (по умолчанию);
+        'incremental' - запрашиваются только записи, измененные после
+        максимального last_modified_at в table_name (за вычетом overlap).
+    overlap: datetime.timedelta
+        Запас по времени для режима incremental.
+    reconcile_days: int
+        Глубина полной сверки, дни.
+    reconcile_weekday: int
+        День недели (0 - понедельник), по которому в режиме incremental
+        выполняется полная сверка за reconcile_days дней.
+    change_detection: bool
+        Если True, перезаписываются только новые и измененные записи
+        (сравнение по хэшу содержимого).
+    hash_table_name: str
+        Таблица хэшей содержимого (id, hash), по умолчанию <table_name>_hash.
+    load_mode: str
+        'replace' - удаление записей по списку id и вставка (по умолчанию);
+        'upsert' - загрузка через COPY во временную таблицу и применение
+        одной командой MERGE / INSERT ... ON CONFLICT (id) DO UPDATE.
+    """
+
     @apply_defaults
     def __init__(
         self,
@@ -243,6 +579,13 @@ class MDAuditOperator(BaseOperator):
         table_name,
         source_connection_id,
         endpoint,
+        sync_mode='full',
+        overlap=dt.timedelta(hours=1),
+        reconcile_days=90,
+        reconcile_weekday=None,
+        change_detection=False,
+        hash_table_name=None,
+        load_mode='replace',
         *args,
         **kwargs,
     ):
@@ -252,6 +595,13 @@ class MDAuditOperator(BaseOperator):
         self.source_con = BaseHook.get_connection(source_connection_id)
         self.url = self.source_con.host + endpoint
         self.headers = json.loads(self.source_con.extra)
+        self.sync_mode = sync_mode
+        self.overlap = overlap
+        self.reconcile_days = reconcile_days
+        self.reconcile_weekday = reconcile_weekday
+        self.change_detection = change_detection
+        self.hash_table_name = hash_table_name
+        self.load_mode = load_mode
 
     def execute(self, context):
         """
@@ -260,25 +610,18 @@ class MDAuditOperator(BaseOperator):
 
         self.context = context
 
-        dwh_connection = psycopg2.connect(
-            host=self.dwh_con.host,
-            port=self.dwh_con.port,
-            database=self.dwh_con.schema,
-            user=self.dwh_con.login,
-            password=self.dwh_con.password,
-        )
-
-        self.dwh_cur = dwh_connection.cursor()
+        with get_dwh_pool(self.dwh_con).connection() as dwh_connection:
+            self.dwh_cur = dwh_connection.cursor()
 
-        with dwh_connection:
-            with self.dwh_cur:
-                self.extract()
-                if self.data:
-                    self.transform()
-                    self.load()
-                    self.check()
-                else:
-                    print('Нет данных для загрузки.')
+            with dwh_connection:
+                with self.dwh_cur:
+                    self.extract()
+                    if self.data:
+                        self.transform()
+                        self.load()
+                        self.check()
+                    else:
+                        print('Нет данных для загрузки.')
 
 
     def extract(self):
@@ -287,13 +630,42 @@ class MDAuditOperator(BaseOperator):
         """
         print('Извлечение данных из REST API.')
 
-        self.start_date = self.context['execution_date'].date() - dt.timedelta(days=90)
+        self.start_date = self.context['execution_date'].date() - dt.timedelta(days=self.reconcile_days)
         self.end_date = self.context['next_execution_date'].date()
 
+        if self.sync_mode == 'incremental':
+            if self.context['execution_date'].weekday() == self.reconcile_weekday:
+                print('Плановая полная сверка за', self.reconcile_days, 'дней.')
+            else:
+                self.dwh_cur.execute(
+                    f"""
+                    SELECT MAX(last_modified_at) FROM {self.table_name};
+                    """
+                )
+                max_last_modified = self.dwh_cur.fetchone()[0]
+                print('Максимальный last_modified_at в хранилище:', max_last_modified)
+
+                if max_last_modified:
+                    # Момент времени остается с часовым поясом: в адресе и в
+                    # условиях удаления он передается со смещением и не зависит
+                    # от часового пояса сессии хранилища
+                    self.start_date = max_last_modified - self.overlap
+                else:
+                    print('Таблица пуста, запрашиваем данные за', self.reconcile_days, 'дней.')
+        elif self.sync_mode != 'full':
+            raise Exception(f'Режим синхронизации {self.sync_mode} не предусмотрен.')
+
         print(f'Запрашиваем данные в {self.url} за период', self.start_date, self.end_date)
 
+        # Дата подставляется как есть (YYYY-MM-DD), момент времени - в формате
+        # ISO 8601 со смещением, экранированном для адреса ('+' -> %2B)
+        if isinstance(self.start_date, dt.datetime):
+            start_param = quote(self.start_date.isoformat(), safe='')
+        else:
+            start_param = self.start_date
+
         response = requests.get(
-            self.url.format(start_date=self.start_date, end_date=self.end_date),
+            self.url.format(start_date=start_param, end_date=self.end_date),
             headers=self.headers,
             verify=False
         )
@@ -324,6 +696,26 @@ class MDAuditOperator(BaseOperator):
             )
             last_modified_field = True if item.get('last_modified_at', None) != None else False
 
+        if self.change_detection:
+            self.load_changed(for_upsert_data, last_modified_field)
+            return
+
+        if self.load_mode == 'upsert':
+            self.upsert(for_upsert_data)
+            if last_modified_field:
+                print('Удаляем записи периода, отсутствующие в источнике.')
+                self.dwh_cur.execute(
+                    f"""
+                    DELETE FROM {self.table_name} t
+                    WHERE t.last_modified_at >= '{self.start_date}'
+                        AND t.last_modified_at < '{self.end_date}'
+                        AND NOT EXISTS (SELECT 1 FROM mdaudit_stage s WHERE s.id = t.id);
+                    """
+                )
+            return
+        elif self.load_mode != 'replace':
+            raise Exception(f'Режим записи {self.load_mode} не предусмотрен.')
+
         ids = ','.join(ids)
 
         print('Обеспечиваем идемпотентность.')
@@ -345,6 +737,196 @@ class MDAuditOperator(BaseOperator):
         insert_stmt = f"INSERT INTO {self.table_name} VALUES %s"
         psycopg2.extras.execute_values(self.dwh_cur, insert_stmt, for_upsert_data)
 
+    def load_changed(self, for_upsert_data, last_modified_field):
+        """
+        Запись в DWH только новых и измененных записей.
+        Для каждой записи хранится хэш содержимого (таблица hash_table_name).
+        Хэши полученных записей загружаются во временную таблицу и сравниваются
+        с сохраненными одним запросом; перезаписываются только записи,
+        у которых хэш отличается или отсутствует. Записи периода, которых
+        больше нет в источнике, удаляются отдельно вместе с их хэшами.
+        """
+        hash_table = self.hash_table_name or f'{self.table_name}_hash'
+
+        self.dwh_cur.execute('SELECT to_regclass(%s);', (hash_table,))
+        if self.dwh_cur.fetchone()[0] is None:
+            print('Создаю таблицу хэшей', hash_table)
+            self.dwh_cur.execute(
+                f"""
+                CREATE TABLE {hash_table} AS
+                SELECT id, md5('') AS hash FROM {self.table_name} WHERE false;
+                """
+            )
+
+        print('Сравниваем хэши полученных записей с сохраненными.')
+        self.dwh_cur.execute(
+            f"""
+            DROP TABLE IF EXISTS pg_temp.mdaudit_stage_hashes_raw;
+            CREATE TEMP TABLE mdaudit_stage_hashes_raw ON COMMIT DROP AS
+            SELECT id, last_modified_at, md5('') AS hash FROM {self.table_name} WHERE false;
+            """
+        )
+        copy_rows(
+            self.dwh_cur,
+            'mdaudit_stage_hashes_raw',
+            (
+                (row[0], row[1], hashlib.md5(json.dumps(item, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest())
+                for row, item in zip(for_upsert_data, self.data)
+            ),
+        )
+        # Один хэш на id: при повторах id в ответе - хэш записи с наибольшим
+        # last_modified_at, как и в upsert(); иначе дубли попадут в таблицу хэшей
+        self.dwh_cur.execute(
+            f"""
+            DROP TABLE IF EXISTS pg_temp.mdaudit_stage_hashes;
+            CREATE TEMP TABLE mdaudit_stage_hashes ON COMMIT DROP AS
+            SELECT DISTINCT ON (id) id, hash
+            FROM mdaudit_stage_hashes_raw
+            ORDER BY id, last_modified_at DESC NULLS LAST;
+            ANALYZE mdaudit_stage_hashes;
+            DROP TABLE IF EXISTS pg_temp.mdaudit_changed;
+            CREATE TEMP TABLE mdaudit_changed ON COMMIT DROP AS
+            SELECT s.id, s.hash, h.id IS NULL AS is_new
+            FROM mdaudit_stage_hashes s
+            LEFT JOIN {hash_table} h ON h.id = s.id
+            WHERE h.id IS NULL OR h.hash <> s.hash;
+            SELECT id, is_new FROM mdaudit_changed;
+            """
+        )
+        changed = {str(record_id): is_new for record_id, is_new in self.dwh_cur.fetchall()}
+
+        new_number = sum(1 for is_new in changed.values() if is_new)
+        changed_number = len(changed) - new_number
+        unchanged_number = len(for_upsert_data) - len(changed)
+
+        deleted_number = 0
+        if last_modified_field:
+            print('Удаляем записи периода, отсутствующие в источнике.')
+            self.dwh_cur.execute(
+                f"""
+                DROP TABLE IF EXISTS pg_temp.mdaudit_deleted;
+                CREATE TEMP TABLE mdaudit_deleted ON COMMIT DROP AS
+                SELECT t.id FROM {self.table_name} t
+                WHERE t.last_modified_at >= '{self.start_date}'
+                    AND t.last_modified_at < '{self.end_date}'
+                    AND NOT EXISTS (SELECT 1 FROM mdaudit_stage_hashes s WHERE s.id = t.id);
+                DELETE FROM {self.table_name} t USING mdaudit_deleted d WHERE t.id = d.id;
+                DELETE FROM {hash_table} h USING mdaudit_deleted d WHERE h.id = d.id;
+                SELECT COUNT(*) FROM mdaudit_deleted;
+                """
+            )
+            deleted_number = self.dwh_cur.fetchone()[0]
+
+        if changed:
+            print('Перезаписываем новые и измененные записи.')
+            self.dwh_cur.execute(
+                f"""
+                DELETE FROM {hash_table} h USING mdaudit_changed c WHERE h.id = c.id;
+                INSERT INTO {hash_table} SELECT id, hash FROM mdaudit_changed;
+                """
+            )
+            changed_rows = [row for row in for_upsert_data if str(row[0]) in changed]
+            if self.load_mode == 'upsert':
+                self.upsert(changed_rows)
+            else:
+                self.dwh_cur.execute(
+                    f"""
+                    DELETE FROM {self.table_name} t USING mdaudit_changed c WHERE t.id = c.id;
+                    """
+                )
+                copy_rows(self.dwh_cur, self.table_name, changed_rows)
+
+        print(
+            'Новых записей:', new_number,
+            'измененных:', changed_number,
+            'без изменений:', unchanged_number,
+            'удаленных:', deleted_number,
+        )
+
+    def upsert(self, rows):
+        """
+        Вставка или обновление записей по id одной командой.
+        Записи загружаются через COPY во временную таблицу mdaudit_stage и
+        применяются через MERGE (PostgreSQL 15+), INSERT ... ON CONFLICT (id)
+        DO UPDATE (PostgreSQL 9.5+, Greenplum 7) или, на более старых версиях
+        (Greenplum 6), через UPDATE ... FROM и INSERT недостающих записей.
+        Для ON CONFLICT на поле id должен быть уникальный индекс.
+        Если в ответе несколько записей с одним id, применяется запись
+        с наибольшим last_modified_at (иначе MERGE и ON CONFLICT
+        завершаются ошибкой).
+        """
+        self.dwh_cur.execute(
+            f"""
+            DROP TABLE IF EXISTS pg_temp.mdaudit_stage_raw;
+            CREATE TEMP TABLE mdaudit_stage_raw ON COMMIT DROP AS
+            SELECT * FROM {self.table_name} WHERE false;
+            """
+        )
+        copy_rows(self.dwh_cur, 'mdaudit_stage_raw', rows)
+        self.dwh_cur.execute(
+            """
+            DROP TABLE IF EXISTS pg_temp.mdaudit_stage;
+            CREATE TEMP TABLE mdaudit_stage ON COMMIT DROP AS
+            SELECT DISTINCT ON (id) *
+            FROM mdaudit_stage_raw
+            ORDER BY id, last_modified_at DESC NULLS LAST;
+            ANALYZE mdaudit_stage;
+            """
+        )
+
+        self.dwh_cur.execute(
+            """
+            SELECT attname
+            FROM pg_catalog.pg_attribute
+            WHERE attrelid = %s::regclass
+                AND attnum > 0
+                AND NOT attisdropped
+            ORDER BY attnum;
+            """,
+            (self.table_name,),
+        )
+        columns = [row[0] for row in self.dwh_cur.fetchall()]
+        updated_columns = [column for column in columns if column != 'id']
+
+        server_version = self.dwh_cur.connection.server_version
+
+        print('Осуществляем upsert записей:', len(rows))
+
+        if server_version >= 150000:
+            self.dwh_cur.execute(
+                f"""
+                MERGE INTO {self.table_name} t
+                USING mdaudit_stage s ON t.id = s.id
+                WHEN MATCHED THEN
+                    UPDATE SET {', '.join(f'{column} = s.{column}' for column in updated_columns)}
+                WHEN NOT MATCHED THEN
+                    INSERT ({', '.join(columns)})
+                    VALUES ({', '.join(f's.{column}' for column in columns)});
+                """
+            )
+        elif server_version >= 90500:
+            self.dwh_cur.execute(
+                f"""
+                INSERT INTO {self.table_name} ({', '.join(columns)})
+                SELECT {', '.join(columns)} FROM mdaudit_stage
+                ON CONFLICT (id) DO UPDATE
+                    SET {', '.join(f'{column} = EXCLUDED.{column}' for column in updated_columns)};
+                """
+            )
+        else:
+            self.dwh_cur.execute(
+                f"""
+                UPDATE {self.table_name} t
+                SET {', '.join(f'{column} = s.{column}' for column in updated_columns)}
+                FROM mdaudit_stage s
+                WHERE t.id = s.id;
+                INSERT INTO {self.table_name} ({', '.join(columns)})
+                SELECT {', '.join(f's.{column}' for column in columns)}
+                FROM mdaudit_stage s
+                WHERE NOT EXISTS (SELECT 1 FROM {self.table_name} t WHERE t.id = s.id);
+                """
+            )
+
     def check(self):
         """
         Проверка результата записи.
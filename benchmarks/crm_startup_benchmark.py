@@ -0,0 +1,82 @@
+"""
+Сравнение времени запуска браузера и загрузки страниц CRM
+для профилей CRMExtractor: 'default' (текущий набор опций)
+и 'fast' (без --verbose, с блокировкой картинок, шрифтов и аналитики
+и постоянным каталогом профиля Chrome).
+
+Адрес CRM берется из переменной окружения CRM_URL,
+логин и пароль (необязательно) - из CRM_LOGIN и CRM_PASSWORD.
+
+Пример запуска:
+    python benchmarks/crm_startup_benchmark.py --repeat 5
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crm import CRMExtractor
+
+
+def run(url, login, password, path, profile, user_data_dir):
+    """
+    Один запуск браузера: время старта, первой и повторной загрузки
+    страницы входа в секундах.
+    """
+
+    started = time.perf_counter()
+    extractor = CRMExtractor(
+        login,
+        password,
+        url,
+        path,
+        profile=profile,
+        user_data_dir=user_data_dir,
+    )
+    startup = time.perf_counter() - started
+    try:
+        started = time.perf_counter()
+        extractor.driver.get(url)
+        first_load = time.perf_counter() - started
+
+        started = time.perf_counter()
+        extractor.driver.get(url)
+        second_load = time.perf_counter() - started
+    finally:
+        extractor.driver.quit()
+    return startup, first_load, second_load
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    url = os.environ['CRM_URL']
+    login = os.environ.get('CRM_LOGIN', '')
+    password = os.environ.get('CRM_PASSWORD', '')
+
+    path = tempfile.mkdtemp(prefix='crm_benchmark_')
+    try:
+        for profile in ('default', 'fast'):
+            user_data_dir = os.path.join(path, 'profile') if profile == 'fast' else None
+            timings = [
+                run(url, login, password, path, profile, user_data_dir)
+                for _ in range(args.repeat)
+            ]
+            for number, name in enumerate(('старт', 'первая загрузка', 'повторная загрузка')):
+                values = [timing[number] for timing in timings]
+                print(
+                    f'{profile:>7}, {name}: лучшее {min(values):.2f} с,',
+                    'замеры:', ', '.join(f'{value:.2f}' for value in values),
+                )
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Сравнение скорости загрузки строк в хранилище:
+execute_values (load_method='insert') и COPY ... FROM STDIN (load_method='copy').
+
+Параметры подключения берутся из переменных окружения:
+DWH_HOST, DWH_PORT, DWH_DATABASE, DWH_USER, DWH_PASSWORD, DWH_SCHEME.
+
+Пример запуска:
+    python benchmarks/load_benchmark.py --rows 1000000
+"""
+import argparse
+import datetime as dt
+import os
+import sys
+import time
+
+import psycopg2
+import psycopg2.extras
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dwh_pool import copy_rows
+
+
+def generate_rows(rows_number):
+    """Синтетические данные, похожие на ежемесячные выгрузки."""
+
+    period = dt.date.today().replace(day=1)
+    ts = dt.datetime.now()
+    return [
+        (i, f'Дилер {i % 500}', f'Комментарий\tс табуляцией {i}', i * 1.5, period, ts)
+        for i in range(rows_number)
+    ]
+
+
+def run(connection, table, rows, method):
+    """Загрузка строк одним из способов, возвращает время в секундах."""
+
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(f'TRUNCATE {table};')
+            started = time.perf_counter()
+            if method == 'copy':
+                copy_rows(cursor, table, rows)
+            else:
+                psycopg2.extras.execute_values(
+                    cursor,
+                    f'INSERT INTO {table} VALUES %s',
+                    rows,
+                )
+            elapsed = time.perf_counter() - started
+            cursor.execute(f'SELECT COUNT(*) FROM {table};')
+            assert cursor.fetchone()[0] == len(rows)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(
+        host=os.environ['DWH_HOST'],
+        port=os.environ.get('DWH_PORT', '5432'),
+        database=os.environ['DWH_DATABASE'],
+        user=os.environ['DWH_USER'],
+        password=os.environ['DWH_PASSWORD'],
+    )
+    table = f"{os.environ.get('DWH_SCHEME', 'public')}.load_benchmark"
+
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                DROP TABLE IF EXISTS {table};
+                CREATE TABLE {table} (
+                    id BIGINT,
+                    dealer TEXT,
+                    comment TEXT,
+                    amount NUMERIC,
+                    period DATE,
+                    ts TIMESTAMP
+                );
+                """
+            )
+
+    rows = generate_rows(args.rows)
+    print('Строк в наборе:', len(rows))
+
+    try:
+        for method in ('insert', 'copy'):
+            timings = [run(connection, table, rows, method) for _ in range(args.repeat)]
+            best = min(timings)
+            print(
+                f'{method:>7}: лучшее {best:.2f} с,',
+                f'{len(rows) / best:,.0f} строк/с,',
+                'замеры:', ', '.join(f'{t:.2f}' for t in timings),
+            )
+    finally:
+        with connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE IF EXISTS {table};')
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,19 @@ import time
 import datetime as dt
 import glob
 import os
+import contextlib
+import re
+import queue
+import json
+import hashlib
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+import openpyxl
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -10,11 +23,78 @@ from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.support.ui import Select
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-
+from selenium.common.exceptions import TimeoutException
+
+from dwh_pool import get_pool, copy_rows
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+
+# Описание отчетов CRM для CRMExtractor.run_report():
+# menu, report - пункт меню и ссылка на отчет,
+# grid - id таблицы отчета, fields - число добавляемых полей,
+# prefix - начало имени файла выгрузки,
+# archive - открыть архив перед настройкой периода,
+# expand - развернуть настройки отчета,
+# refresh - обновить данные после выбора периода (поля добавляются после обновления),
+# open_timeout, columns_timeout - ожидание открытия отчета и шестеренки, с.
+REPORT_SPECS = {
+    'requests': {
+        'menu': 'Процесс продаж',
+        'report': 'Обращения',
+        'grid': 'request-grid',
+        'fields': 10,
+        'prefix': 'Obracsheniya',
+        'archive': True,
+        'expand': True,
+    },
+    'worklists': {
+        'menu': 'Процесс продаж',
+        'report': 'Рабочие лиcты',
+        'grid': 'worklists-grid',
+        'fields': 3,
+        'prefix': 'Rabochie_listy',
+        'expand': True,
+    },
+    'sales': {
+        'menu': 'Отчеты',
+        'report': 'Отчет по продаже ТС',
+        'grid': 'event-grid',
+        'fields': 24,
+        'prefix': 'Otchet_po_prodazhe',
+        'refresh': True,
+        'open_timeout': 30,
+        'columns_timeout': 60,
+    },
+    'stats': {
+        'menu': 'Отчеты',
+        'report': 'Дисциплина работ в CRM',
+        'prefix': 'Disciplina_rabot_v_CRM',
+        'expand': True,
+        'open_timeout': 30,
+    },
+}
+
+# Запросы, блокируемые в профиле 'fast': картинки, шрифты и счетчики аналитики
+BLOCKED_URLS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.svg', '*.webp', '*.ico',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    '*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*',
+    '*mc.yandex.ru*', '*top-fwz1.mail.ru*', '*vk.com/rtrg*',
+]
 
 class CRMExtractor:
 
-    def __init__(self, login, password, url, path, start_date=None, end_date=None):
+    def __init__(self, login, password, url, path, start_date=None, end_date=None, download_mode='browser',
+                 profile='default', user_data_dir=None, session_cache=None):
         self.login = login
         self.password = password 
         self.url = url
@@ -27,6 +107,18 @@ class CRMExtractor:
         else:
             self.end_date = end_date
         self.path = path
+        # Каталог для зашифрованных cookies сессии CRM: вход выполняется
+        # только если сохраненная сессия истекла. Нужен пакет cryptography,
+        # проверяется до запуска браузера.
+        self.session_cache = session_cache
+        if session_cache and Fernet is None:
+            raise Exception('Для кэша сессии необходим пакет cryptography.')
+        # Способ скачивания выгрузки:
+        # 'browser' - нажатием ссылки, файл сохраняет Chrome (по умолчанию),
+        # 'http' - по адресу ссылки через requests с cookies сессии браузера.
+        self.download_mode = download_mode
+        # Сессия requests для режима 'http'
+        self.http = None
 
         # Создание объекта опций Chrome
         self.chrome_options = Options()
@@ -34,7 +126,22 @@ class CRMExtractor:
         # Добавление настроек браузера
         self.chrome_options.add_argument("--window-size=1920,1080")
         self.chrome_options.add_argument("--disable-notifications")              # Отключение всплывающих уведомлений в браузере
-        self.chrome_options.add_argument('--verbose')                            # Уровень журнала. --verbose эквивалентно --log-level=ALL и --silent эквивалентно --log-level=OFF
+        # Профиль браузера:
+        # 'default' - подробный журнал, загружаются все ресурсы страниц,
+        # 'fast' - без подробного журнала, картинки, шрифты и счетчики
+        # аналитики блокируются (BLOCKED_URLS).
+        self.profile = profile
+        if profile == 'fast':
+            self.chrome_options.add_argument('--log-level=3')                    # Только ошибки в журнале
+            self.chrome_options.add_argument('--blink-settings=imagesEnabled=false')
+        else:
+            self.chrome_options.add_argument('--verbose')                        # Уровень журнала. --verbose эквивалентно --log-level=ALL и --silent эквивалентно --log-level=OFF
+        # Постоянный каталог профиля Chrome: кэш и служебные файлы
+        # сохраняются между запусками, повторный старт и загрузка страниц быстрее.
+        # Один каталог одновременно может использовать только один браузер.
+        if user_data_dir:
+            os.makedirs(user_data_dir, exist_ok=True)
+            self.chrome_options.add_argument(f'--user-data-dir={user_data_dir}')
         self.chrome_options.add_argument("--disable-extensions")                 # позволяет отключить все расширения браузера при запуске
         self.chrome_options.add_argument("--start-maximized")                    # Запуск с развернутым на весь экран окном
         self.chrome_options.add_argument('--headless')                           # Headless Browser - это веб-браузер без графического пользовательского интерфейса (GUI)
@@ -56,9 +163,25 @@ class CRMExtractor:
         self.driver = webdriver.Chrome(
             options=self.chrome_options
         )
-        self.driver.delete_all_cookies()
+        if profile == 'fast':
+            # Блокировка лишних запросов на уровне сети через DevTools
+            self.driver.execute_cdp_cmd('Network.enable', {})
+            self.driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URLS})
+        # Очистка всех cookies браузера через DevTools: delete_all_cookies()
+        # на about:blank не затрагивает cookies CRM, сохраненные в user_data_dir
+        self.driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        # Выполнен ли вход в текущей сессии браузера
+        self.authenticated = False
+        # Если True, браузер не закрывается после скачивания отчета
+        self.keep_session = False
+        # Время шагов последней выгрузки: [(шаг, секунды)]
+        self.timings = []
 
     def auth(self):
+        # Вход по сохраненной сессии, если она еще действует
+        if self.session_cache and self.restore_session():
+            self.authenticated = True
+            return
         # Открытие веб-страницы в браузере
         self.driver.get(self.url)
         # Заполнение формы входа
@@ -69,600 +192,957 @@ class CRMExtractor:
         password_field.send_keys(self.password)
         confirm_button = self.driver.find_element(By.NAME, 'login')
         confirm_button.click()
+        self.authenticated = True
+        if self.session_cache:
+            self.save_session()
+
+    def session_file(self):
+        # Файл сессии: имя - хэш логина и адреса CRM, логин в имени не виден
+        name = hashlib.sha256(f'{self.login}@{self.url}'.encode()).hexdigest()
+        return os.path.join(self.session_cache, f'{name}.session')
+
+    def session_key(self):
+        # Ключ шифрования выводится из пароля, соль - логин
+        key = hashlib.pbkdf2_hmac(
+            'sha256',
+            self.password.encode(),
+            self.login.encode(),
+            100000,
+        )
+        return Fernet(base64.urlsafe_b64encode(key))
+
+    def save_session(self):
+        # Сохранение cookies после входа: дожидаемся ухода со страницы входа
+        try:
+            WebDriverWait(self.driver, 30).until(
+                lambda driver: not driver.find_elements(By.NAME, 'username')
+            )
+        except TimeoutException:
+            raise Exception('Вход в CRM не выполнен: форма входа не закрылась.')
+        cookies = json.dumps(self.driver.get_cookies()).encode()
+        os.makedirs(self.session_cache, exist_ok=True)
+        file_path = self.session_file()
+        # Запись через временный файл: браузеры пула могут сохранять сессию одновременно
+        temp_path = f'{file_path}.{os.getpid()}.{id(self)}'
+        with open(temp_path, 'wb') as file:
+            file.write(self.session_key().encrypt(cookies))
+        os.replace(temp_path, file_path)
+        print('Сессия сохранена')
+
+    def restore_session(self):
+        # Восстановление cookies из кэша. Cookies устанавливаются через DevTools
+        # без предварительного открытия страницы, проверка сессии - одна загрузка
+        # главной страницы: если форма входа не показана, сессия действует.
+        file_path = self.session_file()
+        if not os.path.exists(file_path):
+            return False
+        try:
+            with open(file_path, 'rb') as file:
+                cookies = json.loads(self.session_key().decrypt(file.read()))
+        except (InvalidToken, ValueError):
+            print('Сохраненная сессия не читается, выполняю вход')
+            os.remove(file_path)
+            return False
+
+        for cookie in cookies:
+            params = {
+                'name': cookie['name'],
+                'value': cookie['value'],
+                'domain': cookie['domain'],
+                'path': cookie.get('path', '/'),
+                'secure': cookie.get('secure', False),
+                'httpOnly': cookie.get('httpOnly', False),
+            }
+            if 'expiry' in cookie:
+                params['expires'] = cookie['expiry']
+            if cookie.get('sameSite'):
+                params['sameSite'] = cookie['sameSite']
+            self.driver.execute_cdp_cmd('Network.setCookie', params)
 
-    def get_requests(self, division=None):
-        self.auth()
-        # Ожидание загрузки страницы и появления элемента
-        wait = WebDriverWait(self.driver, 20)
-        menu_item = wait.until(
-            EC.element_to_be_clickable((By.LINK_TEXT, 'Процесс продаж'))
+        self.driver.get(self.url)
+        if self.driver.find_elements(By.NAME, 'username'):
+            print('Сохраненная сессия истекла, выполняю вход')
+            self.driver.delete_all_cookies()
+            return False
+        print('Вход по сохраненной сессии')
+        return True
+
+    def open_main_page(self):
+        # Вход выполняется один раз за сессию браузера,
+        # для следующих отчетов открывается главная страница
+        if self.authenticated:
+            print('Перехожу на главную страницу')
+            self.driver.get(self.url)
+        else:
+            self.auth()
+
+    def get_reports(self, reports, division=None):
+        """
+        Выгрузка нескольких отчетов в одной сессии браузера с одним входом.
+        reports - список отчетов из REPORT_SPECS: 'requests', 'worklists', 'sales', 'stats'.
+        Возвращает словарь {отчет: путь к скачанному файлу}.
+        """
+        files = {}
+        self.keep_session = True
+        try:
+            for report in reports:
+                print('Выгружаю отчет', report)
+                self.run_report(report, division)
+                files[report] = self.file
+        finally:
+            self.keep_session = False
+            self.driver.quit()
+        return files
+
+    @contextlib.contextmanager
+    def step(self, name):
+        # Замер времени шага выгрузки, результат печатается и
+        # сохраняется в self.timings
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.timings.append((name, elapsed))
+            print(f'Шаг "{name}": {elapsed:.2f} с')
+
+    def wait_ajax(self, timeout=30):
+        # Ожидание загрузки документа и завершения AJAX-запросов (jQuery)
+        WebDriverWait(self.driver, timeout).until(
+            lambda driver: driver.execute_script(
+                "return document.readyState === 'complete'"
+                " && (typeof jQuery === 'undefined' || jQuery.active === 0);"
+            )
         )
-        # Выбор нужного отчета
-        print('Выбираю в меню нужный отчет (ОБРАЩЕНИЯ)')
-        actions = ActionChains(self.driver)
-        # Перемещение курсора к указанному элементу
-        actions.move_to_element(menu_item).perform()
-        menu_item = self.driver.find_element(By.LINK_TEXT, 'Обращения')
-        print("Адрес ссылки:", menu_item.get_attribute("href"))
-        menu_item.click()
 
-        # Ожидание загрузки страницы и появления элемента шестеренки
-        wait = WebDriverWait(self.driver, 10)
-        element = wait.until(
-            EC.element_to_be_clickable((
-                By.XPATH,
-                '//*[@id="request-grid"]/div[1]/div[1]/button/i'
-            ))
+    def wait_grid(self, grid_id, timeout=60):
+        # Ожидание перезагрузки таблицы: таблица на странице,
+        # индикатор загрузки снят, AJAX-запросов нет
+        WebDriverWait(self.driver, timeout).until(
+            lambda driver: driver.execute_script(
+                "var grid = document.getElementById(arguments[0]);"
+                "return grid !== null && !grid.classList.contains('grid-view-loading');",
+                grid_id,
+            )
         )
-        element.click()
+        self.wait_ajax(timeout)
+
+    def select_option(self, xpath, value=None, text=None, timeout=10):
+        # Выбор значения в выпадающем списке, как только в нем появится
+        # нужный вариант, и ожидание обработки изменения страницей
+        wait = WebDriverWait(self.driver, timeout)
+        element = wait.until(EC.element_to_be_clickable((By.XPATH, xpath)))
+        if value is not None:
+            option_xpath = f'./option[@value="{value}"]'
+        else:
+            option_xpath = f'./option[normalize-space()="{text}"]'
+        wait.until(lambda driver: element.find_elements(By.XPATH, option_xpath))
+        select = Select(element)
+        if value is not None:
+            select.select_by_value(value)
+        else:
+            select.select_by_visible_text(text)
+        self.wait_ajax(timeout)
 
-        print('Добавляю поля в выгрузку')
-        # Добавление полей в выгрузку
-        for _ in range(1,11):
-            try:
-                field_item = wait.until(
-                    EC.element_to_be_clickable((
-                        By.XPATH,
-                        f'//*[@id="modal_customizable"]/div/div/div[2]/div/form/fieldset/div/div[1]/select/option[1]'
-                    ))
-                )
-                field_item.click()
+    def select_division(self, division):
+        # Если выгружаем заявки по BUS, то необходимо выбрать производителя
+        try:
+            self.select_option(
+                '//*[@id="interval_type"]',          ### Исправить
+                text=division,
+                timeout=30,
+            )
+        except:
+            raise Exception(
+                'Элемент для выбора производителя не найден. Возможно, данный элемент недоступен для данного аккаунта.'
+            )
+
+    def set_period(self):
+        # Настройка периода выгрузки: помесячно, с start_date по end_date
+        with self.step('Настройка периода'):
+            print('Выставляю тип выгрузки за месяц')
+            self.select_option('//*[@id="interval_type"]', text='МС', timeout=30)
+
+            print('Выставляю год начала периода')
+            self.select_option('//*[@id="start_year"]', value=str(self.start_date.year))
+
+            print('Выставляю месяц начала периода')
+            self.select_option('//*[@id="counter_min"]', value=str(self.start_date.month))
+
+            print('Выставляю год конца периода')
+            self.select_option('//*[@id="end_year"]', value=str(self.end_date.year))
+
+            print('Выставляю месяц конца периода')
+            self.select_option('//*[@id="counter_max"]', value=str(self.end_date.month))
+
+    def add_fields(self, fields_number):
+        # Перенос полей в выгрузку в окне настройки столбцов: поле переносится,
+        # как только предыдущее исчезло из списка доступных
+        select_xpath = '//*[@id="modal_customizable"]/div/div/div[2]/div/form/fieldset/div/div[1]/select'
+        with self.step('Добавление полей'):
+            print('Добавляю поля в выгрузку')
+            wait = WebDriverWait(self.driver, 10)
+            wait.until(EC.visibility_of_element_located((By.XPATH, select_xpath)))
+            for number in range(fields_number):
+                options = self.driver.find_elements(By.XPATH, select_xpath + '/option')
+                if not options:
+                    break
+                options[0].click()
                 button = self.driver.find_element(
                     By.XPATH,
                     '//*[@id="modal_customizable"]/div/div/div[2]/div/form/fieldset/div/div[2]/a[1]'
                 )
                 button.click()
-            except:
-                break       
-        
-        ok_button = self.driver.find_element(
-            By.XPATH,
-            '//*[@id="modal_customizable"]/div/div/div[3]/button'
-        )
-        ok_button.click()
-
-        # Выбираем ВСЕ ОБРАЩЕНИЕ(АРХИВ)
-        print('Выбираем ВСЕ ОБРАЩЕНИЕ(АРХИВ)')
-        menu_item = wait.until(
-            EC.element_to_be_clickable((By.XPATH, '//*[@id="archive"]/a'))
-        )
-        menu_item.click()
-        time.sleep(15)
-
-        #Настройка отчета
-        print('Разворачиваю настройки отчета')
-        menu_item = wait.until(
-            EC.element_to_be_clickable((
+                try:
+                    wait.until(
+                        lambda driver: len(driver.find_elements(By.XPATH, select_xpath + '/option')) < len(options)
+                    )
+                except TimeoutException:
+                    break
+                print(f'Поле {number + 1} готово.')
+
+            ok_button = self.driver.find_element(
                 By.XPATH,
-                '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[3]/a'
-            ))
-        )
-        menu_item.click()
-
-        # Если выгружаем заявки по BUS, то необходимо выбрать производителя
-        if division:
-            try:
-                menu_item = wait.until(
-                    EC.element_to_be_clickable((
-                        By.XPATH,
-                        '//*[@id="interval_type"]'          ### Исправить
-                    ))
-                )
-                # Выбор элемента из выпадающего списка
-                select = Select(menu_item)
-                select.select_by_visible_text(division)
-            except:
-                raise Exception(
-                    'Элемент для выбора производителя не найден. Возможно, данный элемент недоступен для данного аккаунта.'
-                )           
-
-        print('Выставляю тип выгрузки за месяц')
-        menu_item = wait.until(
-            EC.element_to_be_clickable((
-                By.XPATH,
-                '//*[@id="interval_type"]'
-            ))
-        )
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_visible_text("МС")
-        time.sleep(1)
-
-        print('Выставляю год начала периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="start_year"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.start_date.year))
-        time.sleep(1)
-
-        print('Выставляю месяц начала периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="counter_min"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.start_date.month))
-        time.sleep(1)
-
-        print('Выставляю год конца периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="end_year"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.end_date.year))
-        time.sleep(1)
-
-        print('Выставляю месяц конца периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="counter_max"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.end_date.month))
-        time.sleep(1)
+                '//*[@id="modal_customizable"]/div/div/div[3]/button'
+            )
+            ok_button.click()
+            wait.until(EC.invisibility_of_element_located((By.ID, 'modal_customizable')))
 
+    def clear_folder(self, data_type):
         # Перед скачиванием файла экселя очищаем целевую папку
-        file_pattern = os.path.join(self.path, 'Obracsheniya*')
+        file_pattern = os.path.join(self.path, f'{data_type}*')
         matching_files = glob.glob(file_pattern)
         if matching_files:
             for file_path in matching_files:
                 os.remove(file_path)
                 print(f"Удален файл: {file_path}")
         else:
-            print(f"Файлы, соответствующие шаблону имени 'Obracsheniya*', не найдены.")
-
+            print(f"Файлы, соответствующие шаблону имени '{data_type}*', не найдены.")
+        # Незавершенные загрузки Chrome (в т.ч. 'Unconfirmed *.crdownload'),
+        # оставшиеся от прерванных выгрузок, иначе wait_download их дождется
+        for file_path in glob.glob(os.path.join(self.path, '*.crdownload')):
+            os.remove(file_path)
+            print(f"Удален незавершенный файл: {file_path}")
+
+    def download(self, data_type):
         # Скачивание отчета в эксель
-        print('Нажимаю кнопку')
-        menu_item = self.driver.find_element(
-            By.XPATH,
-            '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[6]/div/a'
-        )
-        self.driver.execute_script(
-            "arguments[0].scrollIntoView({block: 'center', inline: 'center'});",
-            menu_item
-        )
-        actions.move_to_element(menu_item).click().perform()
-        self.ts = dt.datetime.now()
+        with self.step('Запуск выгрузки'):
+            print('Нажимаю кнопку')
+            wait = WebDriverWait(self.driver, 30)
+            menu_item = wait.until(
+                EC.element_to_be_clickable((
+                    By.XPATH,
+                    '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[6]/div/a'
+                ))
+            )
+            self.driver.execute_script(
+                "arguments[0].scrollIntoView({block: 'center', inline: 'center'});",
+                menu_item
+            )
+            wait.until(EC.element_to_be_clickable(menu_item))
+            if self.download_mode == 'http':
+                export_url = menu_item.get_attribute('href')
+            else:
+                ActionChains(self.driver).move_to_element(menu_item).click().perform()
+            self.ts = dt.datetime.now()
 
-        self.file_check('Obracsheniya')
+        with self.step('Скачивание файла'):
+            if self.download_mode == 'http':
+                self.http_download(export_url, data_type)
+            else:
+                self.file_check(data_type)
 
-    def get_worklists(self, division=None):
-        self.auth()
-        # Ожидание загрузки страницы и появления элемента
-        wait = WebDriverWait(self.driver, 20)
-        menu_item = wait.until(
-            EC.element_to_be_clickable((By.LINK_TEXT, 'Процесс продаж'))
+        print(
+            'Время выгрузки по шагам:',
+            ', '.join(f'{name} - {elapsed:.2f} с' for name, elapsed in self.timings),
         )
-        # Выбор нужного отчета
-        print('Выбираю в меню нужный отчет (РАБОЧИЕ ЛИСТЫ)')
-        actions = ActionChains(self.driver)
-        # Перемещение курсора к указанному элементу
-        actions.move_to_element(menu_item).perform()
-        # menu_item = self.driver.find_element(By.LINK_TEXT, 'Рабочие лиcты')
+
+    def open_report(self, menu_text, report_text, timeout=20):
+        # Выбор отчета в меню
+        with self.step('Открытие отчета'):
+            self.open_main_page()
+            # Ожидание загрузки страницы и появления элемента
+            wait = WebDriverWait(self.driver, timeout)
+            menu_item = wait.until(
+                EC.element_to_be_clickable((By.LINK_TEXT, menu_text))
+            )
+            print(f'Выбираю в меню нужный отчет ({report_text})')
+            actions = ActionChains(self.driver)
+            # Перемещение курсора к указанному элементу
+            actions.move_to_element(menu_item).perform()
+            menu_item = wait.until(
+                EC.element_to_be_clickable((By.LINK_TEXT, report_text))
+            )
+            print("Адрес ссылки:", menu_item.get_attribute("href"))
+            menu_item.click()
+            self.wait_ajax(timeout)
+
+    def expand_settings(self):
+        #Настройка отчета
+        print('Разворачиваю настройки отчета')
+        wait = WebDriverWait(self.driver, 30)
         menu_item = wait.until(
-            EC.element_to_be_clickable((By.LINK_TEXT, 'Рабочие лиcты'))
+            EC.element_to_be_clickable((
+                By.XPATH,
+                '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[3]/a'
+            ))
         )
-        print("Адрес ссылки:", menu_item.get_attribute("href"))
         menu_item.click()
 
+    def open_columns(self, grid_id, timeout=10):
         # Ожидание загрузки страницы и появления элемента шестеренки
-        wait = WebDriverWait(self.driver, 10)
+        wait = WebDriverWait(self.driver, timeout)
         element = wait.until(
             EC.element_to_be_clickable((
                 By.XPATH,
-                '//*[@id="worklists-grid"]/div[1]/div[1]/button'
+                f'//*[@id="{grid_id}"]/div[1]/div[1]/button'
             ))
         )
         element.click()
 
-        print('Добавляю поля в выгрузку')
-        # Добавление полей в выгрузку
-        for _ in range(1,4):
-            try:
-                field_item = wait.until(
-                    EC.element_to_be_clickable((
-                        By.XPATH,
-                        f'//*[@id="modal_customizable"]/div/div/div[2]/div/form/fieldset/div/div[1]/select/option[1]'
-                    ))
+    def run_report(self, report, division=None):
+        """
+        Выгрузка отчета по описанию из REPORT_SPECS.
+        report - имя отчета ('requests', 'worklists', 'sales', 'stats')
+        или словарь с описанием отчета того же вида.
+        """
+        spec = REPORT_SPECS[report] if isinstance(report, str) else report
+        grid = spec.get('grid')
+        fields = spec.get('fields', 0)
+
+        self.timings = []
+        self.open_report(spec['menu'], spec['report'], timeout=spec.get('open_timeout', 20))
+
+        if fields and not spec.get('refresh'):
+            self.add_grid_fields(grid, fields, spec.get('columns_timeout', 10))
+
+        if spec.get('archive'):
+            # Выбираем ВСЕ ОБРАЩЕНИЕ(АРХИВ)
+            with self.step('Открытие архива'):
+                print('Выбираем ВСЕ ОБРАЩЕНИЕ(АРХИВ)')
+                menu_item = WebDriverWait(self.driver, 10).until(
+                    EC.element_to_be_clickable((By.XPATH, '//*[@id="archive"]/a'))
                 )
-                field_item.click()
-                button = self.driver.find_element(
-                    By.XPATH,
-                    '//*[@id="modal_customizable"]/div/div/div[2]/div/form/fieldset/div/div[2]/a[1]'
-                )
-                button.click()
-            except:
-                break       
-        
-        ok_button = self.driver.find_element(
-            By.XPATH,
-            '//*[@id="modal_customizable"]/div/div/div[3]/button'
-        )
-        ok_button.click()
-        time.sleep(10)
+                menu_item.click()
+                self.wait_grid(grid, timeout=120)
 
-        #Настройка отчета
-        print('Разворачиваю настройки отчета')
-        menu_item = wait.until(
-            EC.visibility_of_element_located((
-                By.XPATH,
-                '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[3]/a'
-            ))
-        )
-        menu_item.click()
+        if spec.get('expand'):
+            self.expand_settings()
 
-        # Если выгружаем заявки по BUS, то необходимо выбрать производителя
         if division:
-            try:
-                menu_item = wait.until(
+            self.select_division(division)
+
+        self.set_period()
+
+        if spec.get('refresh'):
+            with self.step('Обновление данных'):
+                print('Нажимаю ОБНОВИТЬ ДАННЫЕ')
+                menu_item = WebDriverWait(self.driver, 10).until(
                     EC.element_to_be_clickable((
                         By.XPATH,
-                        '//*[@id="interval_type"]'          ### Исправить
+                        '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[1]/div/div/div[2]/button'
                     ))
                 )
-                # Выбор элемента из выпадающего списка
-                select = Select(menu_item)
-                select.select_by_visible_text(division)
-            except:
-                raise Exception(
-                    'Элемент для выбора производителя не найден. Возможно, данный элемент недоступен для данного аккаунта.'
-                )           
-
-        print('Выставляю тип выгрузки за месяц')
-        menu_item = wait.until(
-            EC.element_to_be_clickable((
-                By.XPATH,
-                '//*[@id="interval_type"]'
-            ))
-        )
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_visible_text("МС")
-        time.sleep(1)
-
-        print('Выставляю год начала периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="start_year"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.start_date.year))
-        time.sleep(1)
-
-        print('Выставляю месяц начала периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="counter_min"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.start_date.month))
-        time.sleep(1)
-
-        print('Выставляю год конца периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="end_year"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.end_date.year))
-        time.sleep(1)
-
-        print('Выставляю месяц конца периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="counter_max"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.end_date.month))
-        time.sleep(1)
+                menu_item.click()
+                self.wait_grid(grid)
+            if fields:
+                self.add_grid_fields(grid, fields, spec.get('columns_timeout', 10))
 
-        # Перед скачиванием файла экселя очищаем целевую папку
-        file_pattern = os.path.join(self.path, 'Rabochie_listy*')
-        matching_files = glob.glob(file_pattern)
-        if matching_files:
-            for file_path in matching_files:
-                os.remove(file_path)
-                print(f"Удален файл: {file_path}")
-        else:
-            print(f"Файлы, соответствующие шаблону имени 'Rabochie_listy*', не найдены.")
+        self.clear_folder(spec['prefix'])
+        self.wait_ajax()
+        self.download(spec['prefix'])
 
-        # Скачивание отчета в эксель
-        print('Нажимаю кнопку')
-        menu_item = self.driver.find_element(
-            By.XPATH,
-            '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[6]/div/a'
-        )
-        self.driver.execute_script(
-            "arguments[0].scrollIntoView({block: 'center', inline: 'center'});",
-            menu_item
-        )
-        actions.move_to_element(menu_item).click().perform()
-        self.ts = dt.datetime.now()
+    def add_grid_fields(self, grid_id, fields_number, timeout=10):
+        # Добавление полей в выгрузку через шестеренку таблицы
+        self.open_columns(grid_id, timeout=timeout)
+        self.add_fields(fields_number)
+        self.wait_grid(grid_id)
 
-        self.file_check('Rabochie_listy')
+    def get_requests(self, division=None):
+        self.run_report('requests', division)
+
+    def get_worklists(self, division=None):
+        self.run_report('worklists', division)
 
     def get_sales(self, division=None):
-        self.auth()
-        # Ожидание загрузки страницы и появления элемента
-        wait = WebDriverWait(self.driver, 30)
-        menu_item = wait.until(
-            EC.element_to_be_clickable((By.LINK_TEXT, 'Отчеты'))
-        )
-        # Выбор нужного отчета
-        print('Выбираю в меню нужный отчет (Отчет по продаже ТС)')
-        actions = ActionChains(self.driver)
-        # Перемещение курсора к указанному элементу
-        actions.move_to_element(menu_item).perform()
-        # menu_item = self.driver.find_element(By.LINK_TEXT, 'Рабочие лиcты')
-        menu_item = wait.until(
-            EC.element_to_be_clickable((By.LINK_TEXT, 'Отчет по продаже ТС'))
-        )
-        print("Адрес ссылки:", menu_item.get_attribute("href"))
-        menu_item.click()
+        self.run_report('sales', division)
 
-        # Если выгружаем заявки по BUS, то необходимо выбрать производителя
-        wait = WebDriverWait(self.driver, 30)
-        if division:
-            try:
-                menu_item = wait.until(
-                    EC.element_to_be_clickable((
-                        By.XPATH,
-                        '//*[@id="interval_type"]'          ### Исправить
-                    ))
-                )
-                # Выбор элемента из выпадающего списка
-                select = Select(menu_item)
-                select.select_by_visible_text(division)
-            except:
-                raise Exception(
-                    'Элемент для выбора производителя не найден. Возможно, данный элемент недоступен для данного аккаунта.'
-                )           
-
-        print('Выставляю тип выгрузки за месяц')
-        menu_item = wait.until(
-            EC.element_to_be_clickable((
-                By.XPATH,
-                '//*[@id="interval_type"]'
-            ))
-        )
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_visible_text("МС")
-        time.sleep(1)
-
-        print('Выставляю год начала периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="start_year"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.start_date.year))
-        time.sleep(1)
-
-        print('Выставляю месяц начала периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="counter_min"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.start_date.month))
-        time.sleep(1)
-
-        print('Выставляю год конца периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="end_year"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.end_date.year))
-        time.sleep(1)
-
-        print('Выставляю месяц конца периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="counter_max"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.end_date.month))
-        time.sleep(1)
-
-        wait = WebDriverWait(self.driver, 10)
-        print('Нажимаю ОБНОВИТЬ ДАННЫЕ')
-        menu_item = wait.until(
-            EC.element_to_be_clickable((
-                By.XPATH,
-                '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[1]/div/div/div[2]/button'
-            ))
-        )
-        menu_item.click()
-    
-        wait = WebDriverWait(self.driver, 60)
-        print('Добавляю поля в выгрузку')
-        # Ожидание загрузки страницы и появления элемента шестеренки
-        element = wait.until(
-            EC.element_to_be_clickable((
-                By.XPATH,
-                '//*[@id="event-grid"]/div[1]/div[1]/button/i'
-            ))
+    def get_stats(self, division=None):
+        self.run_report('stats', division)
+
+    def load_to_dwh(self, dwh, table, columns=None, header_row=1, batch_size=10000, period_header=None,
+                    key_values=None):
+        """
+        Загрузка скачанного файла (self.file) в хранилище, см. load_xlsx().
+        Строки помечаются временем выгрузки self.ts и месяцем выгрузки
+        (или месяцем даты из столбца period_header), перед загрузкой
+        удаляются данные месяцев с start_date по end_date
+        (и значений key_values, например производителя).
+        """
+        return load_xlsx(
+            self.file,
+            dwh,
+            table,
+            self.start_date,
+            self.end_date,
+            self.ts,
+            columns=columns,
+            header_row=header_row,
+            batch_size=batch_size,
+            period_header=period_header,
+            key_values=key_values,
         )
-        element.click()
-        print('Шестеренку нажал')
 
-        # Добавление полей 
-        for _ in range(1,25):
-            try:
-                wait = WebDriverWait(self.driver, 3)
-                field_item = wait.until(
-                    EC.element_to_be_clickable((
-                        By.XPATH,
-                        f'//*[@id="modal_customizable"]/div/div/div[2]/div/form/fieldset/div/div[1]/select/option[1]'
-                    ))
-                )
-                field_item.click()
-                button = self.driver.find_element(
-                    By.XPATH,
-                    '//*[@id="modal_customizable"]/div/div/div[2]/div/form/fieldset/div/div[2]/a[1]'
-                )
-                button.click()
-                print('Поле {_} готово.')
-            except:
-                break       
-        
-        ok_button = self.driver.find_element(
-            By.XPATH,
-            '//*[@id="modal_customizable"]/div/div/div[3]/button'
+    def http_download(self, url, data_type, timeout=180):
+        # Скачивание выгрузки напрямую по HTTP с cookies сессии браузера,
+        # минуя менеджер загрузок Chrome. Файл пишется потоком на диск,
+        # повторы при сбоях касаются только скачивания.
+        if not url or url.startswith('javascript') or url.endswith('#'):
+            raise Exception(
+                'Ссылка выгрузки формируется скриптом, прямое скачивание невозможно:', url
+            )
+
+        if self.http is None:
+            self.http = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=4,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=1,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=('GET',),
+                ),
+            )
+            self.http.mount('http://', adapter)
+            self.http.mount('https://', adapter)
+
+        # Cookies и заголовки браузера переносятся в сессию requests
+        for cookie in self.driver.get_cookies():
+            self.http.cookies.set(
+                cookie['name'],
+                cookie['value'],
+                domain=cookie.get('domain'),
+                path=cookie.get('path', '/'),
+            )
+        self.http.headers['User-Agent'] = self.driver.execute_script('return navigator.userAgent;')
+        self.http.headers['Referer'] = self.driver.current_url
+
+        print('Скачиваю файл по ссылке:', url)
+
+        started = time.perf_counter()
+
+        with self.http.get(url, stream=True, verify=False, timeout=timeout) as response:
+            response.raise_for_status()
+
+            file_name = _content_disposition_filename(response.headers.get('Content-Disposition', ''))
+            if not file_name or not file_name.startswith(f'{data_type}_'):
+                file_name = f'{data_type}_{self.ts:%Y%m%d_%H%M%S}.xlsx'
+            file_path = os.path.join(self.path, file_name)
+
+            # Файл появляется под итоговым именем только после полной записи
+            with open(file_path + '.part', 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+            os.replace(file_path + '.part', file_path)
+
+        self.download_seconds = time.perf_counter() - started
+        self.file_size = os.path.getsize(file_path)
+
+        print(
+            'Файл скачан:', file_path,
+            'размер, байт:', self.file_size,
+            'время скачивания, с:', round(self.download_seconds, 2),
         )
-        ok_button.click()
-        time.sleep(1)        
 
+        if not self.keep_session:
+            self.driver.quit()
+        self.file = file_path
+        self.file_pattern = f'{data_type}*'
 
-        # Перед скачиванием файла экселя очищаем целевую папку
-        file_pattern = os.path.join(self.path, 'Otchet_po_prodazhe*')
-        matching_files = glob.glob(file_pattern)
-        if matching_files:
-            for file_path in matching_files:
-                os.remove(file_path)
-                print(f"Удален файл: {file_path}")
-        else:
-            print(f"Файлы, соответствующие шаблону имени 'Otchet_po_prodazhe*', не найдены.")
+    def file_check(self, data_type, timeout=180):
 
-        # Скачивание отчета в эксель
-        print('Нажимаю кнопку.')
-        time.sleep(10) 
-        wait = WebDriverWait(self.driver, 10)
-        menu_item = wait.until(
-                    EC.element_to_be_clickable((
-                        By.XPATH,
-                        '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[6]/div/a'
-                    ))
-                )
+        file_pattern = os.path.join(self.path, fr'{data_type}_*.xlsx')
+        print('Ищу следующий файл:', file_pattern)
+
+        started = time.perf_counter()
+        file_path, file_size = wait_download(self.path, f'{data_type}_*.xlsx', timeout)
+        self.download_seconds = time.perf_counter() - started
+        self.file_size = file_size
 
-        self.driver.execute_script(
-            "arguments[0].scrollIntoView({block: 'center', inline: 'center'});",
-            menu_item
+        print(
+            'Файл скачан:', file_path,
+            'размер, байт:', file_size,
+            'время ожидания, с:', round(self.download_seconds, 2),
         )
-        time.sleep(1) 
-        actions.move_to_element(menu_item).click().perform()
-        self.ts = dt.datetime.now()
 
-        self.file_check('Otchet_po_prodazhe')
+        if not self.keep_session:
+            self.driver.quit()
+        self.file = file_path
+        self.file_pattern = f'{data_type}*'
 
-    def get_stats(self, division=None):
-        self.auth()
-        # Ожидание загрузки страницы и появления элемента
-        wait = WebDriverWait(self.driver, 30)
-        menu_item = wait.until(
-            EC.element_to_be_clickable((By.LINK_TEXT, 'Отчеты'))
-        )
-        # Выбор нужного отчета
-        print('Выбираю в меню нужный отчет (Дисцмплина работ в CRM)')
-        actions = ActionChains(self.driver)
-        # Перемещение курсора к указанному элементу
-        actions.move_to_element(menu_item).perform()
-        # menu_item = self.driver.find_element(By.LINK_TEXT, 'Рабочие лиcты')
-        menu_item = wait.until(
-            EC.element_to_be_clickable((By.LINK_TEXT, 'Дисциплина работ в CRM'))
-        )
-        print("Адрес ссылки:", menu_item.get_attribute("href"))
-        menu_item.click()
 
-        # Ждем кнопку "развернуть"
-        wait = WebDriverWait(self.driver, 30)
-        menu_item = wait.until(
-            EC.element_to_be_clickable((
-                By.XPATH,
-                '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[3]/a',
-            ))
-        )
-        time.sleep(2)
-        menu_item.click()   
+class CRMExtractorPool:
 
-        # Если выгружаем заявки по BUS, то необходимо выбрать производителя     
-        if division:
+    """
+    Пул изолированных браузеров для параллельной выгрузки отчетов CRM.
+    Каждый браузер (CRMExtractor) работает со своей папкой загрузок
+    path/worker_<N>, входит в CRM один раз и выполняет задания из общей
+    очереди. Скачанные файлы переносятся в path/results под уникальными
+    именами, поэтому очистка папки и поиск файла в разных браузерах
+    не мешают друг другу.
+    """
+
+    def __init__(self, login, password, url, path, size=2, download_mode='browser',
+                 profile='default', user_data_dir=None, session_cache=None):
+        self.login = login
+        self.password = password
+        self.url = url
+        self.path = path
+        self.size = size
+        self.download_mode = download_mode
+        self.profile = profile
+        # Каталог профилей Chrome: у каждого браузера свой user_data_dir/worker_<N>
+        self.user_data_dir = user_data_dir
+        # Каталог кэша сессии CRM, общий для всех браузеров пула
+        self.session_cache = session_cache
+        self.results = []
+
+    def run(self, jobs):
+        """
+        Выполнение заданий на пуле браузеров.
+        jobs - список заданий (report, division, start_date, end_date),
+        report - 'requests', 'worklists', 'sales' или 'stats'.
+        Возвращает результаты в порядке заданий: словари с ключами
+        report, division, start_date, end_date, file, ts, seconds, error.
+        Если часть заданий завершилась ошибкой, исключение выбрасывается
+        после выполнения остальных (результаты доступны в self.results).
+        """
+        results_path = os.path.join(self.path, 'results')
+        os.makedirs(results_path, exist_ok=True)
+
+        job_queue = queue.Queue()
+        for index, job in enumerate(jobs):
+            job_queue.put((index, job))
+        self.results = [None] * len(jobs)
+
+        def worker(number):
+            worker_path = os.path.join(self.path, f'worker_{number}')
+            os.makedirs(worker_path, exist_ok=True)
+            extractor = None
             try:
-                menu_item = wait.until(
-                    EC.element_to_be_clickable((
-                        By.XPATH,
-                        '//*[@id="interval_type"]'          ### Исправить
-                    ))
-                )
-                # Выбор элемента из выпадающего списка
-                select = Select(menu_item)
-                select.select_by_visible_text(division)
-            except:
-                raise Exception(
-                    'Элемент для выбора производителя не найден. Возможно, данный элемент недоступен для данного аккаунта.'
-                )           
-
-        print('Выставляю тип выгрузки за месяц')
-        menu_item = wait.until(
-            EC.element_to_be_clickable((
-                By.XPATH,
-                '//*[@id="interval_type"]'
-            ))
+                while True:
+                    try:
+                        index, (report, division, start_date, end_date) = job_queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    result = {
+                        'report': report,
+                        'division': division,
+                        'start_date': start_date,
+                        'end_date': end_date,
+                        'file': None,
+                        'ts': None,
+                        'seconds': None,
+                        'error': None,
+                    }
+                    started = time.perf_counter()
+                    try:
+                        if extractor is None:
+                            extractor = CRMExtractor(
+                                self.login,
+                                self.password,
+                                self.url,
+                                worker_path,
+                                download_mode=self.download_mode,
+                                profile=self.profile,
+                                user_data_dir=(
+                                    os.path.join(self.user_data_dir, f'worker_{number}')
+                                    if self.user_data_dir else None
+                                ),
+                                session_cache=self.session_cache,
+                            )
+                            extractor.keep_session = True
+                        extractor.start_date = start_date
+                        extractor.end_date = end_date
+                        print(f'Браузер {number}: выгружаю', report, division, start_date, end_date)
+                        extractor.run_report(report, division)
+
+                        file_path = os.path.join(
+                            results_path,
+                            f'{report}_{division or "all"}_{start_date:%Y%m}_{end_date:%Y%m}_{index}.xlsx',
+                        )
+                        os.replace(extractor.file, file_path)
+                        result['file'] = file_path
+                        result['ts'] = extractor.ts
+                    except Exception as e:
+                        result['error'] = repr(e)
+                        print(f'Браузер {number}: ошибка выгрузки', report, repr(e))
+                        # Состояние браузера после ошибки неизвестно, запускаем новый
+                        if extractor is not None:
+                            extractor.driver.quit()
+                            extractor = None
+                    result['seconds'] = time.perf_counter() - started
+                    self.results[index] = result
+            finally:
+                if extractor is not None:
+                    extractor.driver.quit()
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            list(executor.map(worker, range(self.size)))
+
+        print('Результаты выгрузки:')
+        for result in self.results:
+            print(
+                result['report'], result['division'], result['start_date'], result['end_date'],
+                'файл:', result['file'],
+                'время, с:', round(result['seconds'], 2),
+                'ошибка:', result['error'],
+            )
+
+        failed = [result for result in self.results if result['error']]
+        if failed:
+            raise Exception('Не выполнено заданий выгрузки:', len(failed))
+
+        return self.results
+
+    def extract_range(self, report, start_date, end_date, division=None, chunk='month',
+                      output=None, key_columns=None, header_row=1):
+        """
+        Выгрузка отчета за произвольный период частями.
+        Период делится на месяцы или кварталы (chunk='month' или 'quarter'),
+        части выгружаются параллельно на пуле браузеров, файлы объединяются
+        в один с удалением дублей (см. merge_xlsx()).
+        Возвращает путь к объединенному файлу. Для загрузки в хранилище
+        файла за несколько месяцев в load_xlsx() нужен period_header.
+        """
+        jobs = [
+            (report, division, chunk_start, chunk_end)
+            for chunk_start, chunk_end in split_period(start_date, end_date, chunk)
+        ]
+        print('Частей выгрузки:', len(jobs))
+        results = self.run(jobs)
+
+        if not output:
+            output = os.path.join(
+                self.path,
+                'results',
+                f'{report}_{division or "all"}_{start_date:%Y%m}_{end_date:%Y%m}.xlsx',
+            )
+        merge_xlsx(
+            [result['file'] for result in results],
+            output,
+            key_columns=key_columns,
+            header_row=header_row,
+        )
+        return output
+
+
+def split_period(start_date, end_date, chunk='month'):
+    """
+    Деление периода на части по месяцам или кварталам.
+    Возвращает список (начало, конец): начало - первое число месяца,
+    конец - последнее число последнего месяца части, но не позже end_date.
+    """
+    if chunk == 'month':
+        months = 1
+    elif chunk == 'quarter':
+        months = 3
+    else:
+        raise Exception('Неизвестный размер части периода:', chunk)
+    if start_date > end_date:
+        raise Exception('Начало периода позже окончания:', start_date, end_date)
+
+    chunks = []
+    chunk_start = start_date.replace(day=1)
+    while chunk_start <= end_date:
+        if months == 3:
+            # Кварталы календарные: первая часть - до конца текущего квартала
+            month_index = chunk_start.year * 12 + chunk_start.month - 1
+            next_index = (month_index // 3 + 1) * 3
+        else:
+            next_index = chunk_start.year * 12 + chunk_start.month
+        next_start = dt.date(next_index // 12, next_index % 12 + 1, 1)
+        chunk_end = min(next_start - dt.timedelta(days=1), end_date)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = next_start
+    return chunks
+
+
+def merge_xlsx(files, output, key_columns=None, header_row=1):
+    """
+    Объединение выгрузок CRM одного отчета в один файл .xlsx.
+    Файлы читаются и пишутся потоково (openpyxl read_only / write_only).
+    Строки заголовков во всех файлах должны совпадать. Дубли удаляются
+    по столбцам key_columns (заголовки отчета), а если они не указаны -
+    по всей строке; остается первая встреченная строка.
+    Возвращает число записанных строк.
+    """
+    result = openpyxl.Workbook(write_only=True)
+    sheet = result.create_sheet()
+    header = None
+    positions = None
+    keys = set()
+    rows_number = 0
+    duplicates_number = 0
+
+    for file in files:
+        workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            for _ in range(header_row - 1):
+                next(rows, None)
+            file_header = next(rows, None)
+            if file_header is None:
+                print('Пустой файл:', file)
+                continue
+            if header is None:
+                header = file_header
+                sheet.append(header)
+                if key_columns:
+                    missing = [column for column in key_columns if column not in header]
+                    if missing:
+                        raise Exception('Ключевые столбцы не найдены в отчете:', missing)
+                    positions = [header.index(column) for column in key_columns]
+            elif file_header != header:
+                raise Exception('Заголовки файла не совпадают с первым файлом:', file)
+
+            for row in rows:
+                if all(value is None for value in row):
+                    continue
+                key = tuple(row[position] for position in positions) if positions else row
+                if key in keys:
+                    duplicates_number += 1
+                    continue
+                keys.add(key)
+                sheet.append(row)
+                rows_number += 1
+        finally:
+            workbook.close()
+
+    result.save(output)
+    print('Объединено файлов:', len(files), 'строк:', rows_number, 'дублей удалено:', duplicates_number)
+    return rows_number
+
+
+def load_xlsx(file, dwh, table, start_date, end_date, ts,
+              columns=None, header_row=1, batch_size=10000,
+              period_column='period', ts_column='ts', period_header=None,
+              key_values=None):
+    """
+    Потоковая загрузка выгрузки CRM (.xlsx) в Greenplum.
+    Файл читается openpyxl в режиме read_only построчно, строки дополняются
+    периодом (первое число месяца) и временем выгрузки ts и записываются
+    через COPY пачками по batch_size строк. В памяти находится только
+    текущая пачка. Подходит для всех отчетов CRMExtractor.
+
+    Период строки:
+    - если period_header не указан, выгрузка должна быть за один месяц
+      (start_date и end_date в одном месяце), все строки получают этот месяц;
+    - если указан заголовок столбца отчета с датой period_header, период
+      каждой строки - месяц этой даты (для выгрузок за несколько месяцев,
+      например объединенных merge_xlsx()). Даты вне [start_date, end_date]
+      приводят к ошибке.
+
+    dwh - параметры хранилища: host, port, database, user, password.
+    columns - соответствие заголовков отчета полям таблицы
+        {'Заголовок': 'поле'}; строка заголовков ищется среди первых
+        строк листа, остальные столбцы отчета пропускаются. Если не указано,
+        все столбцы пишутся по порядку, начиная со строки header_row + 1,
+        а period и ts добавляются в конец.
+    key_values - дополнительные поля таблицы и их значения для всех строк
+        файла, например {'division': 'BUS'} для выгрузки по производителю.
+        Значения пишутся в строки (после period и ts), а удаление и сверка
+        числа строк ограничиваются ими, чтобы загрузка одного производителя
+        не удаляла данные другого за тот же месяц.
+    Удаление месяцев с start_date по end_date, запись и сверка числа строк
+    выполняются в одной транзакции.
+    """
+
+    period = start_date.replace(day=1)
+    period_end = (end_date.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+    if not period_header and period_end != (period + dt.timedelta(days=32)).replace(day=1):
+        raise Exception(
+            'Выгрузка за несколько месяцев: укажите period_header - столбец с датой строки.',
+            start_date,
+            end_date,
         )
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_visible_text("МС")
-        time.sleep(1)
-
-        print('Выставляю год начала периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="start_year"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.start_date.year))
-        time.sleep(1)
-
-        print('Выставляю месяц начала периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="counter_min"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.start_date.month))
-        time.sleep(1)
-
-        print('Выставляю год конца периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="end_year"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.end_date.year))
-        time.sleep(1)
-
-        print('Выставляю месяц конца периода')
-        menu_item = self.driver.find_element(By.XPATH, '//*[@id="counter_max"]')
-        # Выбор элемента из выпадающего списка
-        select = Select(menu_item)
-        select.select_by_value(str(self.end_date.month))
-        time.sleep(1)
 
-        # Перед скачиванием файла экселя очищаем целевую папку
-        file_pattern = os.path.join(self.path, 'Disciplina_rabot_v_CRM*')
-        matching_files = glob.glob(file_pattern)
-        if matching_files:
-            for file_path in matching_files:
-                os.remove(file_path)
-                print(f"Удален файл: {file_path}")
+    key_values = key_values or {}
+    # Условие удаления и сверки: месяцы выгрузки и дополнительные ключи
+    where_sql = f'{period_column} >= %s AND {period_column} < %s' + ''.join(
+        f' AND {column} IS NOT DISTINCT FROM %s' for column in key_values
+    )
+    where_params = (period, period_end) + tuple(key_values.values())
+    key_row = tuple(key_values.values())
+
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+
+        if columns:
+            # Поиск строки заголовков и позиций нужных столбцов
+            required = list(columns) + ([period_header] if period_header else [])
+            for row_number, row in enumerate(rows, start=1):
+                headers = [str(value).strip() if value is not None else None for value in row]
+                if all(header in headers for header in required):
+                    break
+                if row_number >= 20:
+                    raise Exception('Строка заголовков не найдена:', required)
+            else:
+                raise Exception('Строка заголовков не найдена:', required)
+            positions = [headers.index(header) for header in columns]
+            copy_columns = list(columns.values()) + [period_column, ts_column] + list(key_values)
+            print('Строка заголовков:', row_number)
         else:
-            print(f"Файлы, соответствующие шаблону имени 'Disciplina_rabot_v_CRM*', не найдены.")
+            for _ in range(header_row - 1):
+                next(rows, None)
+            headers = [str(value).strip() if value is not None else None for value in next(rows, ())]
+            if period_header and period_header not in headers:
+                raise Exception('Столбец с датой не найден:', period_header)
+            positions = None
+            copy_columns = None
+        period_position = headers.index(period_header) if period_header else None
+
+        rows_number = 0
+
+        with get_pool(**dwh).connection() as conn, conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    DELETE FROM {table}
+                    WHERE {where_sql};
+                    """,
+                    where_params,
+                )
 
-        # Скачивание отчета в эксель
-        print('Нажимаю кнопку.')
-        time.sleep(3) 
-        wait = WebDriverWait(self.driver, 10)
-        menu_item = wait.until(
-                    EC.element_to_be_clickable((
-                        By.XPATH,
-                        '//*[@id="grand_selector"]/div[1]/div/table[2]/tbody/tr/td[6]/div/a'
-                    ))
+                batch = []
+                for row in rows:
+                    if all(value is None for value in row):
+                        continue
+                    row_period = period
+                    if period_position is not None:
+                        row_period = _row_period(row[period_position] if period_position < len(row) else None)
+                        if not period <= row_period < period_end:
+                            raise Exception('Дата строки вне периода выгрузки:', row[period_position])
+                    if positions is not None:
+                        row = [row[position] if position < len(row) else None for position in positions]
+                    batch.append(tuple(row) + (row_period, ts) + key_row)
+                    if len(batch) >= batch_size:
+                        copy_rows(cursor, table, batch, copy_columns)
+                        rows_number += len(batch)
+                        print('Записано строк:', rows_number)
+                        batch = []
+                if batch:
+                    copy_rows(cursor, table, batch, copy_columns)
+                    rows_number += len(batch)
+
+                cursor.execute(
+                    f"""
+                    SELECT COUNT(*)
+                    FROM {table}
+                    WHERE {where_sql};
+                    """,
+                    where_params,
                 )
+                total_rows_number = cursor.fetchone()[0]
 
-        self.driver.execute_script(
-            "arguments[0].scrollIntoView({block: 'center', inline: 'center'});",
-            menu_item
-        )
-        time.sleep(1) 
-        actions.move_to_element(menu_item).click().perform()
-        self.ts = dt.datetime.now()
+                if total_rows_number != rows_number:
+                    raise Exception(
+                        'Загруженное число строк не совпадает с полученным:',
+                        total_rows_number,
+                        rows_number,
+                    )
+                print('Загружено', rows_number, 'строк из файла', file)
+    finally:
+        workbook.close()
 
-        self.file_check('Disciplina_rabot_v_CRM')        
+    return rows_number
 
-    def file_check(self, data_type):
 
-        counter = 0
-        file_pattern = os.path.join(self.path, fr'{data_type}_*.xlsx')
-        print('Ищу следующий файл:', file_pattern)
+def _row_period(value):
+    """Первое число месяца даты из ячейки отчета (дата или строка)."""
 
-        while True:
-            if counter > 36:
-                raise Exception('За 3 мины выгрузки не произошло!')
-            matching_files = glob.glob(file_pattern)
-            if matching_files:
-                print(f"Найдены файлы, соответствующие части имени:")
-                for file_path in matching_files:
-                    print(file_path)
+    if isinstance(value, str):
+        value = value.strip()
+        for date_format in ('%d.%m.%Y', '%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S'):
+            try:
+                value = dt.datetime.strptime(value, date_format)
                 break
+            except ValueError:
+                pass
+    if isinstance(value, dt.datetime):
+        value = value.date()
+    if not isinstance(value, dt.date):
+        raise Exception('Не удалось определить период строки по значению:', value)
+    return value.replace(day=1)
+
+
+def wait_download(folder, pattern, timeout=180, stable_seconds=0.5):
+    """
+    Ожидание скачивания файла pattern в папку folder: нет его незавершенной
+    загрузки (.crdownload) и размер не меняется stable_seconds секунд.
+    На Linux ожидание идет через inotify, иначе - частой проверкой папки.
+    Возвращает путь к файлу и его размер.
+    """
+
+    deadline = time.monotonic() + timeout
+
+    watcher = None
+    if INotify is not None:
+        watcher = INotify()
+        watcher.add_watch(
+            folder,
+            inotify_flags.CREATE | inotify_flags.MODIFY
+            | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO,
+        )
+
+    try:
+        last_size = None
+        stable_since = None
+
+        while True:
+            matching_files = glob.glob(os.path.join(folder, pattern))
+            in_progress = (
+                glob.glob(os.path.join(folder, f'{pattern}.crdownload'))
+                + glob.glob(os.path.join(folder, 'Unconfirmed *.crdownload'))
+            )
+
+            if matching_files and not in_progress:
+                file_path = max(matching_files, key=os.path.getmtime)
+                size = os.path.getsize(file_path)
+                if size != last_size:
+                    last_size = size
+                    stable_since = time.monotonic()
+                elif size > 0 and time.monotonic() - stable_since >= stable_seconds:
+                    return file_path, size
             else:
-                print(f"Файлы, соответствующие части имени, не найдены.")
-                time.sleep(5)
-                counter += 1
-        self.driver.quit()
-        self.file = matching_files[0]
-        self.file_pattern = f'{data_type}*'
+                last_size = None
+                stable_since = None
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception(f'За {timeout} секунд выгрузки не произошло!')
+
+            # Ожидание изменения в папке или истечения интервала проверки размера
+            interval = min(remaining, stable_seconds if last_size is not None else 1)
+            if watcher is not None:
+                watcher.read(timeout=int(interval * 1000))
+            else:
+                time.sleep(min(interval, 0.1))
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+def _content_disposition_filename(header):
+    """Имя файла из заголовка Content-Disposition."""
+
+    match = re.search(r"filename\*=(?:UTF-8'')?([^;]+)", header, re.IGNORECASE)
+    if match:
+        return os.path.basename(unquote(match.group(1).strip().strip('"')))
+    match = re.search(r'filename="?([^";]+)"?', header, re.IGNORECASE)
+    if match:
+        return os.path.basename(match.group(1).strip())
+    return None
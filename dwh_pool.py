@@ -0,0 +1,233 @@
+import io
+import os
+import time
+import threading
+import collections
+import contextlib
+
+import psycopg2
+import psycopg2.extensions
+
+
+class ConnectionPool:
+
+    """
+    Пул соединений с хранилищем (psycopg2).
+
+    Атрибуты:
+    ----------
+    maxconn: int
+        Максимальное число открытых соединений (свободных и выданных).
+        Если все соединения выданы, getconn() ждет освобождения
+        не дольше checkout_timeout секунд.
+    idle_timeout: int
+        Свободные соединения, простаивающие дольше idle_timeout секунд,
+        закрываются.
+    checkout_timeout: int
+        Время ожидания свободного соединения, секунды.
+    """
+
+    def __init__(self, maxconn=10, idle_timeout=300, checkout_timeout=60, **connect_params):
+        self.connect_params = connect_params
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        # Свободные соединения: (соединение, время возврата в пул)
+        self._idle = collections.deque()
+        # Число открытых соединений, включая выданные
+        self._size = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Выдача соединения на время блока with с возвратом в пул."""
+
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def getconn(self):
+        """
+        Выдача соединения. Свободное соединение перед выдачей
+        проверяется запросом SELECT 1, неисправное закрывается.
+        """
+
+        deadline = time.monotonic() + self.checkout_timeout
+
+        while True:
+            with self._condition:
+                self._evict_idle()
+                if self._idle:
+                    # Последнее возвращенное соединение - самое "теплое"
+                    conn = self._idle.pop()[0]
+                elif self._size < self.maxconn:
+                    self._size += 1
+                    conn = None
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Exception(
+                            'Нет свободных соединений с хранилищем, занято:',
+                            self._size,
+                        )
+                    self._condition.wait(remaining)
+                    continue
+
+            if conn is None:
+                try:
+                    return psycopg2.connect(**self.connect_params)
+                except Exception:
+                    self._discard(None)
+                    raise
+
+            if self._is_alive(conn):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn):
+        """Возврат соединения в пул. Незавершенная транзакция откатывается."""
+
+        if conn.closed:
+            self._discard(None)
+            return
+
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+
+        with self._condition:
+            self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    def grow(self, maxconn):
+        """Увеличение максимального числа соединений, ожидающие getconn() пробуждаются."""
+
+        with self._condition:
+            self.maxconn = max(self.maxconn, maxconn)
+            self._condition.notify_all()
+
+    def closeall(self):
+        """Закрытие всех свободных соединений."""
+
+        with self._condition:
+            while self._idle:
+                self._idle.popleft()[0].close()
+                self._size -= 1
+            self._condition.notify_all()
+
+    def _evict_idle(self):
+        """Закрытие соединений, простаивающих дольше idle_timeout. Вызывается под блокировкой."""
+
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            self._idle.popleft()[0].close()
+            self._size -= 1
+
+    def _discard(self, conn):
+        """Закрытие соединения и освобождение места в пуле."""
+
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    @staticmethod
+    def _is_alive(conn):
+        """Проверка соединения перед выдачей."""
+
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1;')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port, database, user, password, maxconn=None, idle_timeout=None):
+    """
+    Общий для процесса пул соединений с хранилищем.
+    Пулы различаются только параметрами подключения: все объекты с одинаковыми
+    параметрами (ETL, MSSQLOperator, MDAuditOperator) используют один пул.
+    Если maxconn не указан, используется размер существующего пула (для нового - 10).
+    Если разные объекты запрашивают разный maxconn, пул получает наибольший
+    из запрошенных размеров; idle_timeout задается при создании пула (по умолчанию 300).
+    Идентификатор процесса входит в ключ, чтобы дочерние процессы
+    не использовали соединения родителя.
+    """
+
+    key = (os.getpid(), host, str(port), database, user, password)
+
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(
+                maxconn=maxconn or 10,
+                idle_timeout=idle_timeout or 300,
+                host=host,
+                port=port,
+                database=database,
+                user=user,
+                password=password,
+            )
+            _pools[key] = pool
+        else:
+            if maxconn and maxconn > pool.maxconn:
+                print('Размер пула соединений с хранилищем увеличен:', pool.maxconn, '->', maxconn)
+                pool.grow(maxconn)
+            elif maxconn and maxconn < pool.maxconn:
+                print('Пул соединений с хранилищем уже создан с большим размером:', pool.maxconn)
+            if idle_timeout and idle_timeout != pool.idle_timeout:
+                print('Пул соединений с хранилищем уже создан с idle_timeout:', pool.idle_timeout)
+    return pool
+
+
+# Экранирование спецсимволов текстового формата COPY
+_COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+
+def _copy_value(value):
+    """Представление одного значения в текстовом формате COPY."""
+
+    if value is None:
+        return '\\N'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def copy_rows(cursor, table, rows, columns=None):
+    """
+    Загрузка строк в таблицу через COPY ... FROM STDIN.
+    Строки кодируются сразу в буфер в памяти (текстовый формат COPY),
+    без формирования промежуточного текста INSERT.
+    """
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join([_copy_value(value) for value in row]))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    columns_sql = f" ({', '.join(columns)})" if columns else ''
+    cursor.copy_expert(f'COPY {table}{columns_sql} FROM STDIN', buffer)
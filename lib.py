@@ -1,13 +1,27 @@
 import pandas as pd
+import numpy as np
 import datetime as dt
 import requests
 import os
+import re
+import copy
+import time
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import psycopg2
 import psycopg2.extras
 import sqlalchemy as sa
 from urllib.parse import quote
 import pyodbc
 
+from dwh_pool import get_pool, copy_rows
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 
 class ETL:
 
@@ -20,6 +34,9 @@ class ETL:
         dwh_password,
         dwh_scheme,
         dwh_port='5432',
+        # Максимальное число соединений в общем пуле хранилища
+        # (по умолчанию - размер уже созданного пула или 10, см. dwh_pool.get_pool)
+        dwh_pool_size=None,
         # Тип источника данных. Передается обязательно:
         source_type=None,
         # Параметры REST API.
@@ -34,10 +51,27 @@ class ETL:
         #         'meta': ['id', 'shop_id'],
         #         'meta_prefix': "check_",
         #     }
+        # Для больших ответов добавьте 'stream': True - ответ будет разбираться
+        # потоково (нужен пакет ijson) пачками по batch_size записей.
+        # Необязательный 'columns' задает порядок полей результата.
         # Если необходимо нормализовать xml, то укажите следующие параметры(пимер):
         # rest_api_xml_transform={
         #    'xpath': "//KR",     
         #}      
+        # Если API отдает данные постранично, то укажите параметры rest_api_pagination.
+        # Параметры страницы добавляются к параметрам запроса, подстановка
+        # {start_date} и {end_date} при этом сохраняется. Пример:
+        # rest_api_pagination={
+        #     'type': 'offset',             # offset | page | cursor | link
+        #     'page_size': 1000,
+        #     'limit_param': 'limit',       # offset, page: параметр размера страницы
+        #     'offset_param': 'offset',     # offset: параметр смещения
+        #     'page_param': 'page',         # page: параметр номера страницы
+        #     'first_page': 1,              # page: номер первой страницы
+        #     'cursor_param': 'cursor',     # cursor: параметр курсора в запросе
+        #     'cursor_key': 'meta.next',    # cursor: путь до курсора в ответе
+        #     'max_workers': 4,             # offset, page: число параллельных запросов
+        # }
         rest_api_endpoint=None,
         rest_api_method=None,
         rest_api_auth=None,
@@ -47,6 +81,7 @@ class ETL:
         rest_api_data=None,
         rest_api_json_normalize=None,
         rest_api_xml_normalize=None,
+        rest_api_pagination=None,
         # Параметры SQL СУБД
         # Для работы с SQL-источниками, необходимо рядом с файлоь py разместить файл sql-запроса, например:
         # EXECUTE dbo.хп_ДляДашбордов_ЗаявкиДилера '{start_date}'
@@ -57,18 +92,35 @@ class ETL:
         source_password=None,
         sql_script_path=os.path.dirname(os.path.abspath(__file__)),
         sql_normalize=True,
+        # Способ записи строк в хранилище:
+        # 'insert' - execute_values (по умолчанию),
+        # 'copy' - потоковая загрузка через COPY ... FROM STDIN.
+        load_method='insert',
+        # Размер пачки для потоковой загрузки. Если указан, данные
+        # извлекаются пачками (для SQL - fetchmany) и каждая пачка сразу
+        # трансформируется и записывается в хранилище в одной транзакции.
+        batch_size=None,
+        # Стратегия загрузки:
+        # 'delete' - удаление периода (или всей таблицы) и вставка (по умолчанию),
+        # 'stage' - для непериодических данных: загрузка в новую таблицу
+        #           и подмена целевой переименованием в одной короткой транзакции,
+        # 'exchange' - для периодических данных: загрузка в отдельную таблицу
+        #           и обмен с месячной партицией периода (если она есть).
+        load_strategy='delete',
     ):
         """
         В конструктор всегда необходимо подавать параметры хранилища данных.
         Кроме того, необходимо подать параметры одного из источников данных:
         REST API или SQL СУБД.
         """
-        self.__conn = psycopg2.connect(
+        # Соединения берутся из общего для процесса пула
+        self.__pool = get_pool(
             host=dwh_host,
             port=dwh_port,
             database=dwh_database,
             user=dwh_user,
             password=dwh_password,
+            maxconn=dwh_pool_size,
         )
         self.__dwh_scheme = dwh_scheme
         # Сохранение типа источника
@@ -83,6 +135,7 @@ class ETL:
         self.rest_api_data = rest_api_data
         self.rest_api_json_normalize = rest_api_json_normalize
         self.rest_api_xml_normalize = rest_api_xml_normalize
+        self.rest_api_pagination = rest_api_pagination
         # Сохранение параметров SQL СУБД
         self.source_host = source_host
         self.source_database = source_database
@@ -91,6 +144,10 @@ class ETL:
         self.source_password = source_password
         self.sql_script_path = sql_script_path
         self.sql_normalize = sql_normalize
+        # Способ записи строк в хранилище
+        self.load_method = load_method
+        self.batch_size = batch_size
+        self.load_strategy = load_strategy
 
     def etl_start(
         self,
@@ -132,9 +189,116 @@ class ETL:
             
         # Параметры трансформации,
         self.column_names = column_names
+        # Время загрузки, общее для всех строк запуска
+        self.load_ts = dt.datetime.now()
 
         self.manage()
 
+    def backfill(
+        self,
+        start_date,
+        end_date,
+        data_type=None,
+        column_names=None,
+        max_workers=4,
+        executor='thread',
+    ):
+        """
+        Загрузка истории за диапазон [start_date, end_date) помесячно.
+        Периоды извлекаются параллельно (executor='thread' или 'process'),
+        каждый период загружается через одно соединение с хранилищем
+        с удалением периода перед вставкой, как в etl_start().
+        Возвращает отчет по периодам. Если часть периодов завершилась
+        ошибкой, исключение выбрасывается после загрузки остальных.
+        """
+
+        self.data_type = data_type
+        self.periodic_data = True
+        self.column_names = column_names
+        self.load_ts = dt.datetime.now()
+
+        periods = []
+        period_start = start_date.replace(day=1)
+        while period_start < end_date:
+            period_end = (period_start.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+            periods.append((period_start, period_end))
+            period_start = period_end
+
+        print('Загрузка истории, периодов:', len(periods))
+
+        if executor == 'thread':
+            pool = ThreadPoolExecutor(max_workers=max_workers)
+        elif executor == 'process':
+            pool = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            raise Exception(f'Тип пула {executor} не предусмотрен.')
+
+        report = []
+        with pool:
+            futures = {
+                pool.submit(_extract_period, self, period_start, period_end): (period_start, period_end)
+                for period_start, period_end in periods
+            }
+            # Периоды загружаются по мере готовности, пока остальные извлекаются
+            for future in as_completed(futures):
+                period_start, period_end = futures[future]
+                period_report = {
+                    'start_date': period_start,
+                    'end_date': period_end,
+                    'rows': None,
+                    'extract_seconds': None,
+                    'load_seconds': None,
+                    'error': None,
+                }
+                report.append(period_report)
+                try:
+                    data, period_report['extract_seconds'] = future.result()
+                    period_report['rows'] = len(data)
+
+                    started = time.perf_counter()
+                    self.start_date = period_start
+                    self.end_date = period_end
+                    self.data = data
+                    if len(self.data) != 0:
+                        self.load()
+                    else:
+                        print('Нет новых данных для загрузки за период', period_start)
+                    period_report['load_seconds'] = time.perf_counter() - started
+                except Exception as e:
+                    period_report['error'] = repr(e)
+                    print('Ошибка загрузки периода', period_start, ':', repr(e))
+                finally:
+                    self.data = None
+
+        report.sort(key=lambda item: item['start_date'])
+
+        print('Отчет о загрузке истории:')
+        for item in report:
+            print(
+                item['start_date'],
+                item['end_date'],
+                'строк:', item['rows'],
+                'извлечение, с:', item['extract_seconds'] and round(item['extract_seconds'], 2),
+                'загрузка, с:', item['load_seconds'] and round(item['load_seconds'], 2),
+                'ошибка:', item['error'],
+            )
+
+        failed = [item for item in report if item['error']]
+        if failed:
+            raise Exception(
+                'Не загружены периоды:',
+                [str(item['start_date']) for item in failed],
+            )
+
+        return report
+
+    def __getstate__(self):
+        """При передаче в другой процесс пул соединений с хранилищем не копируется."""
+
+        state = self.__dict__.copy()
+        state.pop('_ETL__pool', None)
+        return state
+
     def manage(self):
         """Выбор загрузчика для требуемого источника данных."""
 
@@ -146,6 +310,13 @@ class ETL:
                 ({self.source_type}_extract) не предусмотрено."""
             )
 
+        data_batches = getattr(self, f'{self.source_type}_batches', None)
+        # Потоковый разбор json всегда идет пачками, без объединения ответа в памяти
+        streaming = self.source_type == 'rest_api' and self._rest_api_json_streaming()
+        if (self.batch_size or streaming) and data_batches:
+            self.stream(data_batches())
+            return
+
         data_extract()
         if len(self.data) != 0:
             self.transform()
@@ -158,6 +329,130 @@ class ETL:
         
         print('Извлечение данных из REST API.')
 
+        if self.rest_api_pagination or self._rest_api_json_streaming():
+            frames = list(self._rest_api_frames())
+            if frames:
+                self.data = pd.concat(frames, ignore_index=True).values
+            else:
+                self.data = []
+            return
+
+        url, data = self._rest_api_request_params()
+        response = self._rest_api_request(url, data)
+
+        if self.rest_api_json_normalize or self.rest_api_xml_normalize:
+            self.data = self._rest_api_normalize(response)[0].values
+        else:
+            self.data = [(response.text,)]
+
+    def rest_api_batches(self):
+        """
+        Извлечение данных из REST API пачками: постранично или
+        потоковым разбором json. Используется в потоковом режиме, см. stream().
+        """
+
+        if not (self.rest_api_pagination or self._rest_api_json_streaming()):
+            self.rest_api_extract()
+            yield self.data
+            return
+
+        columns = None
+        if self.rest_api_json_normalize:
+            columns = self.rest_api_json_normalize.get('columns', None)
+
+        for frame in self._rest_api_frames():
+            # Столбцы всех пачек приводятся к столбцам первой пачки
+            # (или к явно заданным columns), так как запись в хранилище
+            # идет по позициям
+            if columns is None:
+                columns = list(frame.columns)
+            elif list(frame.columns) != list(columns):
+                new_columns = set(frame.columns) - set(columns)
+                if new_columns:
+                    raise Exception(
+                        'В пачке появились поля, которых не было в первой пачке:',
+                        new_columns,
+                    )
+                frame = frame.reindex(columns=columns)
+            yield frame.values
+
+    def _rest_api_frames(self):
+        """Генератор нормализованных пачек (DataFrame) из REST API."""
+
+        if self.rest_api_pagination:
+            return self._rest_api_pages()
+        return self._rest_api_json_stream()
+
+    def _rest_api_json_streaming(self):
+        """Включен ли потоковый разбор json."""
+
+        return bool(
+            self.rest_api_json_normalize
+            and self.rest_api_json_normalize.get('stream', False)
+        )
+
+    def _rest_api_json_stream(self):
+        """
+        Потоковый разбор json. Ответ читается по мере поступления (stream=True),
+        записи под json_key разбираются по одной и нормализуются пачками
+        по batch_size записей с той же семантикой record_path, meta и
+        meta_prefix, что и pd.json_normalize. В памяти находится одна пачка.
+        Если массив записей не найден (под json_key или в корне ответа),
+        выбрасывается исключение.
+        """
+
+        if ijson is None:
+            raise Exception('Для потокового разбора json необходим пакет ijson.')
+
+        url, data = self._rest_api_request_params()
+        batch_size = self.batch_size or self.rest_api_json_normalize.get('batch_size', 10000)
+        json_key = self.rest_api_json_normalize.get('json_key', None)
+        array_prefix = json_key or ''
+        found = []
+
+        def events(source):
+            # События разбора с проверкой, что записи лежат в массиве
+            for number, (event_prefix, event, value) in enumerate(ijson.parse(source, use_float=True)):
+                if event_prefix == array_prefix and event == 'start_array':
+                    found.append(True)
+                elif number == 0 and not json_key:
+                    raise Exception(
+                        'Корень ответа json не является массивом, укажите json_key в rest_api_json_normalize.'
+                    )
+                yield event_prefix, event, value
+
+        with self._rest_api_request(url, data, stream=True) as response:
+            response.raw.decode_content = True
+
+            records = []
+            records_number = 0
+            for record in ijson.items(events(response.raw), f'{array_prefix}.item' if json_key else 'item'):
+                records.append(record)
+                if len(records) >= batch_size:
+                    records_number += len(records)
+                    yield self._rest_api_json_frame(records)
+                    records = []
+            if records:
+                records_number += len(records)
+                yield self._rest_api_json_frame(records)
+
+        if not found:
+            raise Exception('В ответе json не найден массив записей:', json_key)
+        print('Разобрано записей json:', records_number)
+
+    def _rest_api_json_frame(self, records):
+        """Нормализация пачки записей json."""
+
+        return pd.json_normalize(
+            records,
+            self.rest_api_json_normalize.get('record_path', None),
+            self.rest_api_json_normalize.get('meta', None),
+            self.rest_api_json_normalize.get('meta_prefix', None),
+        )
+
+    def _rest_api_request_params(self):
+        """Формирование url и тела запроса с подстановкой дат."""
+
         if self.rest_api_params_dict:
             counter = len(self.rest_api_params_dict) - 1
             query_string = '?'
@@ -174,9 +469,9 @@ class ETL:
         url = self.rest_api_endpoint + query_string \
             .format(start_date=self.start_date, end_date=self.end_date)
 
-        if self.rest_api_data:
-            self.rest_api_data = self.rest_api_data \
-                .format(start_date=self.start_date, end_date=self.end_date)
+        data = self.rest_api_data
+        if data:
+            data = data.format(start_date=self.start_date, end_date=self.end_date)
 
         print(
             'Параметры подключения:',
@@ -189,14 +484,26 @@ class ETL:
             'Заголовки:',
             self.rest_api_headers,
             'Данные:',
-            self.rest_api_data,
+            data,
+            'Пагинация:',
+            self.rest_api_pagination,
         )
 
+        return url, data
+
+    def _rest_api_request(self, url, data, params=None, stream=False):
+        """
+        Один запрос к REST API. params дописываются к параметрам url.
+        При stream=True тело ответа читается по мере обработки.
+        """
+
         response = getattr(requests, self.rest_api_method)(
             url,
+            params=params,
+            stream=stream,
             auth=self.rest_api_auth,
             headers=self.rest_api_headers,
-            data=self.rest_api_data,
+            data=data,
             verify=False,
         )
 
@@ -205,49 +512,146 @@ class ETL:
         # Раскомментировать строку ниже, если проблемы с кодировкой
         # response.encoding = 'utf-8-sig'
 
+        return response
+
+    def _rest_api_normalize(self, response, body=None):
+        """
+        Нормализация ответа REST API в DataFrame.
+        Возвращает DataFrame и число записей верхнего уровня в ответе
+        (по нему определяется последняя страница).
+        """
+
         if self.rest_api_json_normalize:
+            if body is None:
+                body = response.json()
             json_key = self.rest_api_json_normalize.get('json_key', None)
             if json_key:
-                self.data = response.json()[json_key]
-            else:
-                self.data = response.json()
+                body = body[json_key]
 
-            self.data = pd.json_normalize(
-                self.data,
+            frame = pd.json_normalize(
+                body,
                 self.rest_api_json_normalize.get('record_path', None),
                 self.rest_api_json_normalize.get('meta', None),
                 self.rest_api_json_normalize.get('meta_prefix', None),
-            ).values           
+            )
+            return frame, len(body)
         elif self.rest_api_xml_normalize:
-            self.data = pd.read_xml(
+            frame = pd.read_xml(
                 response.text,
                 xpath=self.rest_api_xml_normalize.get('xpath', None)
-            ).values
+            )
+            return frame, len(frame)
         else:
-            self.data = [(response.text,)]
+            raise Exception(
+                'Для постраничного извлечения необходимо указать '
+                'rest_api_json_normalize или rest_api_xml_normalize.'
+            )
+
+    def _rest_api_pages(self):
+        """Генератор нормализованных страниц в порядке их следования."""
+
+        url, data = self._rest_api_request_params()
+        pagination_type = self.rest_api_pagination.get('type', 'offset')
+
+        if pagination_type in ('offset', 'page'):
+            pages = self._rest_api_numbered_pages(url, data)
+        elif pagination_type in ('cursor', 'link'):
+            pages = self._rest_api_chained_pages(url, data)
+        else:
+            raise Exception(f'Тип пагинации {pagination_type} не предусмотрен.')
+
+        pages_number = 0
+        for frame in pages:
+            pages_number += 1
+            if len(frame):
+                yield frame
+        print('Получено страниц:', pages_number)
+
+    def _rest_api_numbered_pages(self, url, data):
+        """
+        Страницы по смещению (offset/limit) или по номеру (page).
+        Номер каждой страницы известен заранее, поэтому страницы
+        запрашиваются параллельно: в работе всегда max_workers запросов.
+        Каждая страница нормализуется в потоке, который ее получил.
+        Последняя страница - первая, на которой записей меньше page_size.
+        """
+
+        pagination = self.rest_api_pagination
+        page_size = pagination['page_size']
+        max_workers = pagination.get('max_workers', 4)
+
+        def page_params(number):
+            if pagination.get('type', 'offset') == 'offset':
+                return {
+                    pagination.get('offset_param', 'offset'): number * page_size,
+                    pagination.get('limit_param', 'limit'): page_size,
+                }
+            return {
+                pagination.get('page_param', 'page'): pagination.get('first_page', 1) + number,
+                pagination.get('limit_param', 'limit'): page_size,
+            }
+
+        def fetch(number):
+            return self._rest_api_normalize(
+                self._rest_api_request(url, data, page_params(number))
+            )
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = collections.deque(
+                executor.submit(fetch, number) for number in range(max_workers)
+            )
+            next_number = max_workers
+
+            while pending:
+                frame, records_number = pending.popleft().result()
+                yield frame
+                if records_number < page_size:
+                    # Страницы за последней не нужны
+                    for future in pending:
+                        future.cancel()
+                    break
+                pending.append(executor.submit(fetch, next_number))
+                next_number += 1
+
+    def _rest_api_chained_pages(self, url, data):
+        """
+        Страницы по курсору (cursor) или по заголовку Link (link).
+        Адрес следующей страницы известен только из ответа на предыдущую,
+        поэтому страницы запрашиваются последовательно.
+        """
+
+        pagination = self.rest_api_pagination
+        params = None
+
+        while True:
+            response = self._rest_api_request(url, data, params)
+
+            if pagination['type'] == 'link':
+                frame, _ = self._rest_api_normalize(response)
+                url = response.links.get('next', {}).get('url')
+                params = None
+                data_left = bool(url)
+            else:
+                body = response.json()
+                cursor = body
+                for key in pagination.get('cursor_key', 'next_cursor').split('.'):
+                    cursor = cursor.get(key) if isinstance(cursor, dict) else None
+                frame, records_number = self._rest_api_normalize(response, body)
+                params = {pagination.get('cursor_param', 'cursor'): cursor}
+                data_left = bool(cursor) and records_number > 0
+
+            yield frame
+
+            if not data_left:
+                break
 
     def sql_extract(self):
         """Извлечение данных из SQL СУБД."""
         
         print('Извлечение данных из SQL СУБД.')
 
-        print('Путь до sql-скрипта:', self.sql_script_path)
-
-        with open(
-            os.path.join(self.sql_script_path, f'{self.data_type}.sql'),
-            'r',
-            encoding="utf-8",
-        ) as f:
-            query = f.read().format(
-                start_date=self.start_date,
-                end_date=self.end_date
-            )
-        print(query)
-
-        if os.name == 'nt':
-            driver = 'SQL Server'
-        else:
-            driver = 'ODBC Driver 18 for SQL Server'
+        query = self._sql_query()
+        driver = self._sql_driver()
 
         if not self.sql_normalize:
 
@@ -266,12 +670,7 @@ class ETL:
             self.data = [(json_data,)]
             
         else:
-            con = pyodbc.connect(
-                'DRIVER={'+driver+'};SERVER='+self.source_host \
-                + ';DATABASE='+self.source_database \
-                + ';ENCRYPT=no;UID='+self.source_user \
-                + ';PWD=' + self.source_password
-            )
+            con = pyodbc.connect(self._sql_connection_string(driver))
             with con:
                 with con.cursor() as cursor:
                     cursor.execute(query)
@@ -279,79 +678,523 @@ class ETL:
 
         print(self.data[:10])
 
+    def sql_batches(self):
+        """
+        Извлечение данных из SQL СУБД пачками по batch_size строк (fetchmany).
+        Используется в потоковом режиме, см. stream().
+        """
+
+        if not self.sql_normalize:
+            # Результат сворачивается в один json, читать его пачками нельзя
+            self.sql_extract()
+            yield self.data
+            return
+
+        print('Извлечение данных из SQL СУБД пачками по', self.batch_size, 'строк.')
+
+        query = self._sql_query()
+
+        con = pyodbc.connect(self._sql_connection_string(self._sql_driver()))
+        with con:
+            with con.cursor() as cursor:
+                cursor.execute(query)
+                while True:
+                    rows = cursor.fetchmany(self.batch_size)
+                    if not rows:
+                        break
+                    yield rows
+
+    def _sql_query(self):
+        """Чтение и шаблонизация sql-скрипта источника."""
+
+        print('Путь до sql-скрипта:', self.sql_script_path)
+
+        with open(
+            os.path.join(self.sql_script_path, f'{self.data_type}.sql'),
+            'r',
+            encoding="utf-8",
+        ) as f:
+            query = f.read().format(
+                start_date=self.start_date,
+                end_date=self.end_date
+            )
+        print(query)
+        return query
+
+    @staticmethod
+    def _sql_driver():
+        """Имя ODBC-драйвера MSSQL для текущей ОС."""
+
+        if os.name == 'nt':
+            return 'SQL Server'
+        return 'ODBC Driver 18 for SQL Server'
+
+    def _sql_connection_string(self, driver):
+        """Строка подключения pyodbc к источнику."""
+
+        return (
+            'DRIVER={'+driver+'};SERVER='+self.source_host \
+            + ';DATABASE='+self.source_database \
+            + ';ENCRYPT=no;UID='+self.source_user \
+            + ';PWD=' + self.source_password
+        )
+
     def transform(self):
         """Преобразование/трансформация данных."""
 
         print('ТРАНСФОРМАЦИЯ ДАННЫХ')
 
-        result = []
-        for item in self.data:
-            new_item = list(item)
-            if self.periodic_data:
-                new_item.append(self.start_date)
-            new_item.append(dt.datetime.now())
-            result.append(tuple(new_item))
-        self.data = result
+        self.data = self._transform_rows(self.data)
+
+    def _transform_rows(self, rows):
+        """
+        Добавление к строкам периода и времени загрузки.
+        Время загрузки одно на весь запуск (self.load_ts).
+        Массив NumPy (результат pd.json_normalize/pd.read_xml) дополняется
+        столбцами целиком, без обхода строк в Python.
+        """
+
+        extra_values = [self.start_date] if self.periodic_data else []
+        extra_values.append(self.load_ts)
+
+        if isinstance(rows, np.ndarray) and rows.ndim == 2:
+            extra_columns = np.empty((rows.shape[0], len(extra_values)), dtype=object)
+            extra_columns[:] = extra_values
+            return np.hstack([rows.astype(object, copy=False), extra_columns])
+
+        extra_values = tuple(extra_values)
+        return [tuple(item) + extra_values for item in rows]
 
     def load(self):
         """Загрузка данных в хранилище."""
 
         print('Загрузка данных в хранилище.')
 
-        initial_rows_number = len(self.data)
+        self._write_batches([self.data])
+
+    def stream(self, batches):
+        """
+        Потоковая загрузка: каждая пачка проходит трансформацию и сразу
+        записывается в хранилище. При стратегии delete удаление, запись всех
+        пачек и проверка выполняются в одной транзакции. В памяти находится
+        только текущая пачка.
+        """
+
+        batches = iter(batches)
+        first_batch = next(batches, None)
+        if first_batch is None or len(first_batch) == 0:
+            print('Нет новых данных для загрузки.')
+            return
+
+        print('Загрузка данных в хранилище пачками.')
+
+        self._write_batches(
+            self._transform_rows(batch)
+            for batch in itertools.chain([first_batch], batches)
+            if len(batch) != 0
+        )
+
+    def _write_batches(self, batches):
+        """Запись пачек в хранилище согласно стратегии загрузки (load_strategy)."""
+
+        if self.load_strategy == 'stage':
+            self._stage_load(batches)
+        elif self.load_strategy == 'exchange':
+            self._exchange_load(batches)
+        elif self.load_strategy == 'delete':
+            self._delete_load(batches)
+        else:
+            raise Exception(
+                f'Стратегия загрузки {self.load_strategy} не предусмотрена.'
+            )
+
+    def _delete_load(self, batches):
+        """Удаление периода (или всей таблицы) и вставка в одной транзакции."""
 
-        with self.__conn:
-            with self.__conn.cursor() as cursor:
+        initial_rows_number = 0
 
-                if self.periodic_data:
+        with self.__pool.connection() as conn, conn:
+            with conn.cursor() as cursor:
+                self._delete_target(cursor)
+
+                for batch in batches:
+                    self._insert_rows(cursor, batch)
+                    initial_rows_number += len(batch)
+                    print('Записано строк:', initial_rows_number)
+
+                self._check_rows(cursor, initial_rows_number)
+
+    def _stage_load(self, batches):
+        """
+        Загрузка непериодических данных подменой таблицы.
+        Данные пишутся в новую таблицу той же структуры (LIKE ... INCLUDING ALL)
+        и с теми же параметрами хранения (reloptions: appendoptimized,
+        orientation, compresstype и т.д.), пока целевая таблица доступна читателям в прежнем виде, число строк
+        сверяется по новой таблице. Затем в одной транзакции целевая таблица
+        переименовывается в <таблица>__old, новая получает ее имя, права
+        и владельца, зависимые представления пересоздаются над новой таблицей
+        (CREATE OR REPLACE VIEW сохраняет их права и вложенные представления),
+        старая таблица удаляется. Под блокировкой выполняются только изменения
+        каталога, читатели ждут доли секунды, а не всю загрузку.
+        Партиционированные таблицы и таблицы с настройками сжатия отдельных
+        столбцов подменой не загружаются: их структуру так не воспроизвести.
+        """
+
+        if self.periodic_data:
+            raise Exception('Стратегия stage применяется только к непериодическим данным.')
+
+        table = f'{self.__dwh_scheme}.{self.data_type}'
+        new_table = f'{self.__dwh_scheme}.{self.data_type}__new'
+        old_table = f'{self.__dwh_scheme}.{self.data_type}__old'
+
+        initial_rows_number = 0
+
+        with self.__pool.connection() as conn:
+            try:
+                with conn, conn.cursor() as cursor:
                     cursor.execute(
-                        f"""
-                        DELETE FROM {self.__dwh_scheme}.{self.data_type}
-                        WHERE period >= '{self.start_date}'
-                            AND period < '{self.end_date}';
                         """
+                        SELECT
+                            array_to_string(c.reloptions, ', '),
+                            EXISTS (SELECT 1 FROM pg_catalog.pg_inherits WHERE inhparent = c.oid)
+                        FROM pg_catalog.pg_class c
+                        WHERE c.oid = %s::regclass;
+                        """,
+                        (table,),
                     )
-                else:
+                    storage_options, partitioned = cursor.fetchone()
+                    if partitioned:
+                        raise Exception(
+                            f'Таблица {table} партиционирована, стратегия stage к ней не применяется.'
+                        )
+                    # Сжатие отдельных столбцов (Greenplum) через LIKE не переносится
+                    cursor.execute(
+                        """
+                        SELECT to_regclass('pg_catalog.pg_attribute_encoding') IS NOT NULL;
+                        """
+                    )
+                    if cursor.fetchone()[0]:
+                        cursor.execute(
+                            """
+                            SELECT EXISTS (
+                                SELECT 1 FROM pg_catalog.pg_attribute_encoding
+                                WHERE attrelid = %s::regclass
+                            );
+                            """,
+                            (table,),
+                        )
+                        if cursor.fetchone()[0]:
+                            raise Exception(
+                                f'У таблицы {table} заданы параметры сжатия столбцов, '
+                                'стратегия stage к ней не применяется.'
+                            )
+                    with_sql = f' WITH ({storage_options})' if storage_options else ''
+
+                    print('Заполняю новую таблицу', new_table)
                     cursor.execute(
                         f"""
-                        DELETE FROM {self.__dwh_scheme}.{self.data_type};
+                        DROP TABLE IF EXISTS {new_table};
+                        DROP TABLE IF EXISTS {old_table};
+                        CREATE TABLE {new_table} (LIKE {table} INCLUDING ALL){with_sql};
                         """
                     )
+                    for batch in batches:
+                        self._insert_rows(cursor, batch, new_table)
+                        initial_rows_number += len(batch)
+                        print('Записано строк:', initial_rows_number)
 
-                if initial_rows_number > 1:
-                    insert_stmt = f"INSERT INTO {self.__dwh_scheme}.{self.data_type} VALUES %s"
-                    psycopg2.extras.execute_values(cursor, insert_stmt, self.data)
-                else:
-                    placeholders = ', '.join(['%s'] * len(self.data[0]))
-                    insert_stmt = f"INSERT INTO {self.__dwh_scheme}.{self.data_type} VALUES ({placeholders})"
-                    cursor.execute(insert_stmt, self.data[0])
+                    cursor.execute(f'SELECT COUNT(*) FROM {new_table};')
+                    new_rows_number = cursor.fetchone()[0]
+                    if new_rows_number != initial_rows_number:
+                        raise Exception(
+                            'Загруженное число строк не совпадает с полученным:',
+                            new_rows_number,
+                            initial_rows_number,
+                        )
+                    cursor.execute(f'ANALYZE {new_table};')
+
+                with conn, conn.cursor() as cursor:
+                    print('Подменяю таблицу', table)
+                    # Блокировка берется сразу, чтобы права и определения
+                    # представлений не изменились до переименования
+                    cursor.execute(f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE;')
+
+                    cursor.execute(
+                        """
+                        SELECT
+                            pg_get_userbyid(c.relowner),
+                            CASE WHEN a.grantee = 0 THEN 'PUBLIC'
+                                ELSE quote_ident(pg_get_userbyid(a.grantee)) END,
+                            a.privilege_type,
+                            a.is_grantable
+                        FROM pg_class c
+                        LEFT JOIN LATERAL aclexplode(c.relacl) a
+                            ON a.grantee <> c.relowner
+                        WHERE c.oid = %s::regclass;
+                        """,
+                        (table,),
+                    )
+                    grants = cursor.fetchall()
+                    owner = grants[0][0]
 
-                if self.periodic_data:
                     cursor.execute(
-                        f"""
-                        SELECT COUNT(*)
-                        FROM {self.__dwh_scheme}.{self.data_type}
-                        WHERE period >= '{self.start_date}'
-                            AND period < '{self.end_date}';
                         """
+                        SELECT DISTINCT v.oid::regclass::text, pg_get_viewdef(v.oid)
+                        FROM pg_depend d
+                        JOIN pg_rewrite r ON r.oid = d.objid
+                        JOIN pg_class v ON v.oid = r.ev_class
+                        WHERE d.classid = 'pg_rewrite'::regclass
+                            AND d.refobjid = %s::regclass
+                            AND v.oid <> d.refobjid
+                            AND v.relkind = 'v';
+                        """,
+                        (table,),
                     )
-                else:
+                    views = cursor.fetchall()
+
                     cursor.execute(
                         f"""
-                        SELECT COUNT(*)
-                        FROM {self.__dwh_scheme}.{self.data_type};
+                        ALTER TABLE {table} RENAME TO {self.data_type}__old;
+                        ALTER TABLE {new_table} RENAME TO {self.data_type};
                         """
                     )
-                
-                total_rows_number = cursor.fetchone()[0]
+                    cursor.execute('SELECT current_user;')
+                    if cursor.fetchone()[0] != owner:
+                        cursor.execute(f'ALTER TABLE {table} OWNER TO {owner};')
+                    for _, grantee, privilege, is_grantable in grants:
+                        if grantee is None:
+                            continue
+                        cursor.execute(
+                            f"""
+                            GRANT {privilege} ON {table} TO {grantee}
+                            {'WITH GRANT OPTION' if is_grantable else ''};
+                            """
+                        )
+                    for view, definition in views:
+                        print('Пересоздаю представление', view)
+                        cursor.execute(f'CREATE OR REPLACE VIEW {view} AS {definition}')
+
+                    # Без CASCADE: если на старой таблице осталась зависимость,
+                    # транзакция откатится и целевая таблица останется прежней
+                    cursor.execute(f'DROP TABLE {old_table};')
+            finally:
+                with conn, conn.cursor() as cursor:
+                    cursor.execute(f'DROP TABLE IF EXISTS {new_table};')
+
+    def _exchange_load(self, batches):
+        """
+        Загрузка периодических данных обменом партиции (Greenplum).
+        Если целевая таблица разбита на партиции по диапазону period и одна
+        из партиций в точности совпадает с [start_date, end_date), данные
+        пишутся в отдельную таблицу с теми же параметрами хранения, число строк
+        сверяется по ней, после чего она обменивается с партицией
+        (ALTER TABLE ... EXCHANGE PARTITION). Прежние данные периода удаляются
+        вместе с обменянной таблицей, без DELETE и COUNT(*) по диапазону.
+        Если подходящей партиции нет, используется удаление и вставка.
+        """
+
+        if not self.periodic_data:
+            raise Exception('Стратегия exchange применяется только к периодическим данным.')
+
+        table = f'{self.__dwh_scheme}.{self.data_type}'
+        exchange_table = f'{self.__dwh_scheme}.{self.data_type}__exchange'
+
+        with self.__pool.connection() as conn:
+            with conn, conn.cursor() as cursor:
+                partition = self._find_partition(cursor)
 
+        if partition is None:
+            print('Партиция для периода не найдена, загружаю через удаление периода.')
+            self._delete_load(batches)
+            return
+
+        print('Загружаю период через обмен партиции', partition)
+
+        initial_rows_number = 0
+
+        with self.__pool.connection() as conn, conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT array_to_string(reloptions, ', ')
+                    FROM pg_catalog.pg_class
+                    WHERE oid = %s::regclass;
+                    """,
+                    (partition,),
+                )
+                storage_options = cursor.fetchone()[0]
+                with_sql = f' WITH ({storage_options})' if storage_options else ''
+
+                cursor.execute(
+                    f"""
+                    DROP TABLE IF EXISTS {exchange_table};
+                    CREATE TABLE {exchange_table} (LIKE {partition} INCLUDING DEFAULTS){with_sql};
+                    """
+                )
+
+                for batch in batches:
+                    self._insert_rows(cursor, batch, exchange_table)
+                    initial_rows_number += len(batch)
+                    print('Записано строк:', initial_rows_number)
+
+                cursor.execute(f'SELECT COUNT(*) FROM {exchange_table};')
+                total_rows_number = cursor.fetchone()[0]
                 if total_rows_number != initial_rows_number:
                     raise Exception(
                         'Загруженное число строк не совпадает с полученным:',
                         total_rows_number,
                         initial_rows_number,
                     )
-                else:
-                    print('Загружено', initial_rows_number, 'строк.')
 
+                cursor.execute(
+                    f"""
+                    ALTER TABLE {table}
+                    EXCHANGE PARTITION FOR (%s) WITH TABLE {exchange_table};
+                    DROP TABLE {exchange_table};
+                    """,
+                    (self.start_date,),
+                )
+
+                print('Загружено', initial_rows_number, 'строк.')
+
+    def _find_partition(self, cursor):
+        """
+        Поиск партиции первого уровня, диапазон которой совпадает
+        с [start_date, end_date). Возвращает имя партиции или None.
+        """
+
+        cursor.execute("SELECT to_regclass('pg_catalog.pg_partitions');")
+        if cursor.fetchone()[0] is None:
+            return None
+
+        cursor.execute(
+            """
+            SELECT partitionschemaname,
+                partitiontablename,
+                partitionlevel,
+                partitiontype,
+                partitionrangestart,
+                partitionstartinclusive,
+                partitionrangeend,
+                partitionendinclusive
+            FROM pg_catalog.pg_partitions
+            WHERE schemaname = %s
+                AND tablename = %s;
+            """,
+            (self.__dwh_scheme, self.data_type),
+        )
+        partitions = cursor.fetchall()
+
+        # Обмен возможен только для таблиц без подпартиций
+        if any(partition[2] > 0 for partition in partitions):
+            return None
+
+        for (schema, name, _, partition_type, range_start, start_inclusive,
+             range_end, end_inclusive) in partitions:
+            if partition_type != 'range' or not start_inclusive or end_inclusive:
+                continue
+            # Границы хранятся как выражения, например '2024-01-01'::date
+            if (_range_bound_date(range_start) == str(self.start_date)[:10]
+                    and _range_bound_date(range_end) == str(self.end_date)[:10]):
+                return f'{schema}.{name}'
+
+        return None
+
+    def _delete_target(self, cursor):
+        """Удаление загружаемого периода (или всей таблицы) для идемпотентности."""
+
+        if self.periodic_data:
+            cursor.execute(
+                f"""
+                DELETE FROM {self.__dwh_scheme}.{self.data_type}
+                WHERE period >= '{self.start_date}'
+                    AND period < '{self.end_date}';
+                """
+            )
+        else:
+            cursor.execute(
+                f"""
+                DELETE FROM {self.__dwh_scheme}.{self.data_type};
+                """
+            )
+
+    def _check_rows(self, cursor, initial_rows_number):
+        """Сверка числа строк в хранилище с числом полученных строк."""
+
+        if self.periodic_data:
+            cursor.execute(
+                f"""
+                SELECT COUNT(*)
+                FROM {self.__dwh_scheme}.{self.data_type}
+                WHERE period >= '{self.start_date}'
+                    AND period < '{self.end_date}';
+                """
+            )
+        else:
+            cursor.execute(
+                f"""
+                SELECT COUNT(*)
+                FROM {self.__dwh_scheme}.{self.data_type};
+                """
+            )
+        
+        total_rows_number = cursor.fetchone()[0]
+
+        if total_rows_number != initial_rows_number:
+            raise Exception(
+                'Загруженное число строк не совпадает с полученным:',
+                total_rows_number,
+                initial_rows_number,
+            )
+        else:
+            print('Загружено', initial_rows_number, 'строк.')
+
+    def _insert_rows(self, cursor, rows, table=None):
+        """Запись строк в целевую (или указанную) таблицу выбранным способом (load_method)."""
+
+        if table is None:
+            table = f'{self.__dwh_scheme}.{self.data_type}'
+
+        if self.load_method == 'copy':
+            copy_rows(cursor, table, rows)
+        elif self.load_method == 'insert':
+            if isinstance(rows, np.ndarray):
+                rows = rows.tolist()
+            if len(rows) > 1:
+                insert_stmt = f"INSERT INTO {table} VALUES %s"
+                psycopg2.extras.execute_values(cursor, insert_stmt, rows)
+            else:
+                placeholders = ', '.join(['%s'] * len(rows[0]))
+                insert_stmt = f"INSERT INTO {table} VALUES ({placeholders})"
+                cursor.execute(insert_stmt, rows[0])
+        else:
+            raise Exception(
+                f'Способ загрузки {self.load_method} не предусмотрен.'
+            )
+
+
+def _range_bound_date(bound):
+    """Дата из выражения границы партиции ('2024-01-01 00:00:00'::timestamp)."""
+
+    if not bound:
+        return None
+    match = re.search(r"'([^']*)'", bound)
+    return match.group(1)[:10] if match else None
+
+
+def _extract_period(etl, start_date, end_date):
+    """
+    Извлечение и трансформация одного периода для ETL.backfill().
+    Работает с копией объекта, чтобы параллельные периоды не мешали друг другу.
+    Возвращает данные и время извлечения в секундах.
+    """
+
+    etl = copy.copy(etl)
+    etl.start_date = start_date
+    etl.end_date = end_date
 
+    started = time.perf_counter()
+    getattr(etl, f'{etl.source_type}_extract')()
+    if len(etl.data) != 0:
+        etl.transform()
+    return etl.data, time.perf_counter() - started